@@ -0,0 +1,44 @@
+"""Per-call overhead of capture_caller_directory against the inspect.stack() version it replaced.
+
+Run from the repository root with: python -m benchmarks.caller_directory
+"""
+
+import inspect
+import pathlib
+import timeit
+
+from embedded import build
+
+CALLS = 2000
+REPEATS = 5
+
+def capture_with_stack(function):
+    # capture_caller_directory before it read only the caller's frame.
+    def wrapper(*args, **kwargs):
+        if "caller_directory" not in kwargs or kwargs["caller_directory"] is None:
+            caller_frame = inspect.stack()[1].filename
+            kwargs["caller_directory"] = pathlib.Path(caller_frame).parent
+        return function(*args, **kwargs)
+    return wrapper
+
+def step(caller_directory=None):
+    return caller_directory
+
+before = capture_with_stack(step)
+after = build.capture_caller_directory(step)
+
+def at_depth(depth, function):
+    """Call function with depth more frames on the stack, as a build script's nested coroutines would."""
+    if depth:
+        return at_depth(depth - 1, function)
+    return function()
+
+def per_call(function, depth):
+    best = min(timeit.repeat(lambda: at_depth(depth, function), number=CALLS, repeat=REPEATS))
+    return best / CALLS * 1e6
+
+if __name__ == "__main__":
+    assert before() == after()
+    print(f"{'stack depth':>12} {'before':>12} {'after':>12}")
+    for depth in (0, 20):
+        print(f"{depth:>12} {per_call(before, depth):>10.2f}us {per_call(after, depth):>10.2f}us")
@@ -1,97 +1,484 @@
 import asyncio
-import inspect
+import collections
+import concurrent.futures
+import functools
+import heapq
+import itertools
 import logging
+import multiprocessing
+import os
 import pathlib
 import shlex
-import time
+import sys
 import atexit
-import json
+import contextlib
+
+from . import history
+from . import incremental
+from . import jobserver
+from . import process
+from . import remote
+from . import trace
 
 logger = logging.getLogger(__name__)
+# Output of commands, line by line as it arrives.
+output_logger = logging.getLogger(__name__ + ".output")
 
 shared_semaphore = None
 
-trace_entries = []
-def save_trace():
-    with open("trace.json", "w") as f:
-        json.dump(trace_entries, f)
+# Where persistent build information, such as the up-to-date state, is kept.
+state_directory = pathlib.Path.cwd() / ".embedded-build"
+state = None
+# Durations of past steps.
+step_history = None
+
+# Number of builds started by this process. Caches that only hold for one build are keyed by it.
+generation = 0
+
+# When set, commands with outputs are handed to this ninja.Recorder instead of being run.
+recorder = None
+
+# Chrome trace of the build. Set trace_file to None before init() to disable it.
+trace_file = "trace.json"
+trace_sink = None
+# Jobs holding a slot and jobs waiting for one.
+running_jobs = 0
+waiting_jobs = 0
+slot_count = 1
+
+# Priority added to steps that others are waiting on, such as links, so they run first.
+CRITICAL_PRIORITY = 1_000_000
+# Jobs waiting for a slot as (-priority, arrival order, future, slots, memory). The longest jobs are
+# started first.
+_waiters = []
+_arrivals = itertools.count()
+_dispatcher = None
+
+# Bytes of memory that running jobs may use together, or None for no limit. Jobs are expected to
+# use as much as they did at their peak last time.
+memory_budget = None
+# Share of the memory available at init() that's budgeted for jobs by default.
+MEMORY_FRACTION = 0.9
+# New jobs wait while the one minute load average is above max_load, if set. By default it's
+# LOAD_FACTOR times the number of CPUs.
+max_load = None
+LOAD_FACTOR = 1.5
+# Seconds between checks of the load average while jobs are held back by it.
+LOAD_CHECK_INTERVAL = 0.5
+# Jobs that have been given slots and the memory they're expected to use.
+admitted_jobs = 0
+reserved_memory = 0
+# Future the dispatcher waits on for a job to finish.
+_resources_freed = None
+
+def close_trace():
+    if trace_sink is not None:
+        trace_sink.close()
+
+atexit.register(close_trace)
+
+def close_jobserver():
+    if isinstance(shared_semaphore, jobserver.Jobserver):
+        shared_semaphore.close()
+
+atexit.register(close_jobserver)
+
+# Worker processes for run_function(), started when first asked for.
+process_pool = None
+
+def close_process_pool():
+    global process_pool
+    if process_pool is not None:
+        process_pool.shutdown(cancel_futures=True)
+        process_pool = None
+
+atexit.register(close_process_pool)
 
-atexit.register(save_trace)
+def save_state():
+    if state is not None:
+        state.save()
+    if step_history is not None:
+        step_history.save()
 
-def init(job_count=1):
+atexit.register(save_state)
+
+def init(job_count=1, use_jobserver=True, memory_limit=None, load_limit=None):
+    """Set up job slots for job_count concurrent jobs.
+
+    With use_jobserver, the slots can be shared with commands run with use_jobserver=True, such as
+    ninja and make, through MAKEFLAGS. Jobs are also held back while they would use more
+    than memory_limit bytes together, by default most of the memory available now, and while
+    the load average is above load_limit. A limit of 0 turns it off.
+    """
     global shared_semaphore
-    shared_semaphore = asyncio.BoundedSemaphore(job_count)
+    if isinstance(shared_semaphore, jobserver.Jobserver):
+        shared_semaphore.close()
+    if use_jobserver and hasattr(os, "mkfifo"):
+        shared_semaphore = jobserver.Jobserver(job_count)
+    else:
+        shared_semaphore = asyncio.BoundedSemaphore(job_count)
+
+    global state
+    state = incremental.State(state_directory / "state.pickle")
+    global step_history
+    step_history = history.History(state_directory / "history")
 
-    global tracks
+    global tracks, slot_count
     tracks = list(reversed(range(job_count)))
+    slot_count = job_count
+
+    global memory_budget, max_load, admitted_jobs, reserved_memory
+    if memory_limit is None:
+        available = trace.available_memory()
+        memory_limit = int(available * MEMORY_FRACTION) if available is not None else 0
+    memory_budget = memory_limit or None
+    if load_limit is None:
+        load_limit = LOAD_FACTOR * (os.cpu_count() or 1) if hasattr(os, "getloadavg") else 0
+    max_load = load_limit or None
+    admitted_jobs = 0
+    reserved_memory = 0
+    close_process_pool()
+
+    start_trace()
+
+def start_trace():
+    """Start a new trace, replacing the last one, if trace_file is set."""
+    global trace_sink
+    close_trace()
+    trace_sink = None
+    if trace_file is not None:
+        trace_sink = trace.Trace(trace_file, slot_count)
+
+@functools.lru_cache(maxsize=None)
+def _directory_of(filename):
+    return pathlib.Path(filename).parent
 
 def capture_caller_directory(function):
+    @functools.wraps(function)
     def wrapper(*args, **kwargs):
         # Don't override a given caller_directory.
-        if "caller_directory" not in kwargs or kwargs["caller_directory"] is None:
-            caller_frame = inspect.stack()[1].filename
-            caller_directory = pathlib.Path(caller_frame).parent
-            kwargs["caller_directory"] = caller_directory
+        if kwargs.get("caller_directory") is None:
+            # Only the caller's frame is needed. inspect.stack() would read source for every frame.
+            kwargs["caller_directory"] = _directory_of(sys._getframe(1).f_code.co_filename)
 
         return function(*args, **kwargs)
 
     return wrapper
 
+class Jobs:
+    """Command argument for the number of jobs a tool may run, such as ninja's -j.
+
+    The tool runs in its job's slot plus any that are free when it starts. The argument is
+    template formatted with the count. Until then it stays a constant so that it doesn't
+    change the command line as far as up-to-date checks are concerned.
+    """
+    def __init__(self, template="{}"):
+        self.template = template
+
+    def __str__(self):
+        return self.template
+
+def format_command(command, working_directory, jobs=None) -> list[str]:
+    """Convert the parts of command to strings with paths relative to working_directory."""
+    parts = []
+    for part in command:
+        if isinstance(part, pathlib.Path):
+            part = part.relative_to(working_directory, walk_up=True)
+        elif isinstance(part, Jobs) and jobs is not None:
+            part = part.template.format(jobs)
+        parts.append(str(part))
+    return parts
+
+def _count_jobs():
+    if trace_sink is None:
+        return
+    timestamp = trace.now()
+    trace_sink.counters(timestamp, "jobs", {"running": running_jobs, "waiting": waiting_jobs})
+    trace_sink.counters(timestamp, "reserved memory", {"MB": reserved_memory // (1024 * 1024)})
+    trace_sink.sample_system(timestamp)
+
+def priority(description=None, outputs=(), critical=False):
+    """Expected duration of a step in seconds, from earlier builds, plus a boost for critical steps."""
+    result = 0
+    if step_history is not None:
+        result = step_history.duration(history.History.key(outputs, description), step_history.typical_duration())
+    if critical:
+        result += CRITICAL_PRIORITY
+    return result
+
+def resources(description=None, outputs=(), slots=None, memory=None):
+    """Job slots and bytes of memory a step needs, as learned from earlier builds unless given."""
+    key = history.History.key(outputs, description)
+    if slots is None:
+        slots = 1
+        if step_history is not None:
+            slots = round(step_history.value(key, "cpus", 1))
+    if memory is None:
+        memory = 0
+        if step_history is not None:
+            memory = step_history.value(key, "memory", step_history.typical("memory"))
+    # More slots than there are would never be free together.
+    return min(max(slots, 1), slot_count), memory
+
+def _admissible(memory) -> bool:
+    """Whether a job fits in the memory budget and load limit. A lone job always does."""
+    if admitted_jobs == 0:
+        return True
+    if memory_budget is not None and reserved_memory + memory > memory_budget:
+        return False
+    if max_load is not None and os.getloadavg()[0] > max_load:
+        return False
+    return True
+
+async def _wait_for_resources():
+    global _resources_freed
+    _resources_freed = asyncio.get_running_loop().create_future()
+    try:
+        # The load average changes without jobs finishing.
+        await asyncio.wait_for(_resources_freed, LOAD_CHECK_INTERVAL)
+    except TimeoutError:
+        pass
+
+async def _dispatch():
+    global admitted_jobs, reserved_memory
+    # Slots taken for the job at the front that it doesn't have yet.
+    held = 0
+    try:
+        # Let jobs started together queue up so the longest goes first rather than the first to ask.
+        await asyncio.sleep(0)
+        while True:
+            while _waiters and _waiters[0][2].done():
+                heapq.heappop(_waiters)
+            if not _waiters:
+                break
+            _, _, waiter, slots, memory = _waiters[0]
+            if held < slots:
+                await shared_semaphore.acquire()
+                held += 1
+                continue
+            # The front job waits for memory rather than letting smaller jobs past, so that big
+            # jobs such as links aren't held back for ever.
+            if not _admissible(memory):
+                await _wait_for_resources()
+                continue
+            heapq.heappop(_waiters)
+            held -= slots
+            admitted_jobs += 1
+            reserved_memory += memory
+            waiter.set_result(None)
+    finally:
+        for _ in range(held):
+            shared_semaphore.release()
+
+def _release(slots, memory):
+    global admitted_jobs, reserved_memory
+    admitted_jobs -= 1
+    reserved_memory -= memory
+    for _ in range(slots):
+        shared_semaphore.release()
+    if _resources_freed is not None and not _resources_freed.done():
+        _resources_freed.set_result(None)
+
+async def _acquire(priority, slots, memory):
+    global _dispatcher
+    waiter = asyncio.get_running_loop().create_future()
+    heapq.heappush(_waiters, (-priority, next(_arrivals), waiter, slots, memory))
+    if _dispatcher is None or _dispatcher.done():
+        _dispatcher = asyncio.ensure_future(_dispatch())
+    try:
+        await waiter
+    except asyncio.CancelledError:
+        # We may have been handed a slot just before being cancelled.
+        if waiter.done() and not waiter.cancelled():
+            _release(slots, memory)
+        raise
+
+@contextlib.asynccontextmanager
+async def spare_slots():
+    """Take the job slots that are free right now, without waiting, and yield how many were taken.
+
+    Slots aren't taken from under jobs that are already waiting for one.
+    """
+    count = 0
+    while not _waiters and not shared_semaphore.locked():
+        # Await even though we should get it immediately.
+        await shared_semaphore.acquire()
+        count += 1
+    try:
+        yield count
+    finally:
+        for _ in range(count):
+            shared_semaphore.release()
+
+@contextlib.asynccontextmanager
+async def job_slot(priority=0, slots=1, memory=0):
+    """Hold slots of the shared job slots and yield the trace track to use.
+
+    Waiting jobs get slots highest priority first, once there's memory for them too.
+    """
+    global running_jobs, waiting_jobs
+    waiting_jobs += 1
+    _count_jobs()
+    try:
+        await _acquire(priority, slots, memory)
+    finally:
+        waiting_jobs -= 1
+    running_jobs += 1
+    track = tracks.pop()
+    _count_jobs()
+    try:
+        yield track
+    finally:
+        tracks.append(track)
+        running_jobs -= 1
+        _release(slots, memory)
+        _count_jobs()
+
+def _trace_step(name, track, start, end, args, inputs, outputs):
+    if trace_sink is None:
+        return
+    if outputs:
+        output_size = 0
+        for output in outputs:
+            try:
+                output_size += os.path.getsize(output)
+            except OSError:
+                pass
+        args["output_size"] = output_size
+    trace_sink.complete(name, track, start, end, args, inputs, outputs)
+
+def record_duration(description, outputs, start_time, end_time, rusage=None, memory=None):
+    """Remember how long a successful step took, in trace microseconds, the CPU time in rusage and
+    its peak memory in bytes, for planning later builds.
+    """
+    if step_history is None:
+        return
+    cpu_time = None
+    if rusage is not None:
+        cpu_time = rusage.ru_utime + rusage.ru_stime
+    step_history.record(history.History.key(outputs, description), (end_time - start_time) / 1_000_000, cpu_time, memory)
+
+def _log_line(stream, line):
+    output_logger.debug(line)
+
 @capture_caller_directory
-async def run_command(command, description=None, caller_directory=None, working_directory=None):
+async def run_command(command, description=None, caller_directory=None, working_directory=None, shell=False, output=None, inputs=(), outputs=(), trace_args=None, critical=False, slots=None, memory=None, use_jobserver=False) -> process.Result:
+    """Run command and return its process.Result. Raises RuntimeError when it fails.
+
+    A list command is executed directly unless shell is True. Output is streamed to the
+    embedded.build.output logger at debug level and kept in output, a bounded deque by default.
+    inputs and outputs link the step to others in the trace. trace_args adds metadata to its
+    trace event. Commands that took longest before, and critical ones, are started first.
+    The command holds as many job slots as CPUs it used before, and is expected to use as much
+    memory, unless slots or memory in bytes are given. With use_jobserver, the command gets the
+    shared jobserver in MAKEFLAGS, if there is one, and may take more slots from it. While a
+    recorder is set, commands with outputs are recorded rather than run.
+    """
     if working_directory is None:
         working_directory = caller_directory
-    if isinstance(command, list):
-        for i, part in enumerate(command):
-            if isinstance(part, pathlib.Path):
-                part = part.relative_to(working_directory, walk_up=True)
-            # if isinstance(part, list):
-
-            command[i] = str(part)
-        command = " ".join(command)
-
-    async with shared_semaphore:
-        track = tracks.pop()
-        start_time = time.perf_counter_ns() // 1000
-        process = await asyncio.create_subprocess_shell(
-            command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            cwd=working_directory)
-
-        stdout, stderr = await process.communicate()
-        end_time = time.perf_counter_ns() // 1000
-        trace_entries.append({"name": command if not description else description, "ph": "X", "pid": 0, "tid": track, "ts": start_time, "dur": end_time - start_time})
-        tracks.append(track)
+    if recorder is not None and outputs:
+        # Ninja doesn't say how many slots are free so tools get as many as the build has.
+        recorder.add(format_command(command, working_directory, jobs=slot_count) if isinstance(command, list) else command, working_directory, description, inputs, outputs)
+        return process.Result(0, collections.deque(), None)
+    uses_jobs = isinstance(command, list) and any(isinstance(part, Jobs) for part in command)
+    if uses_jobs:
+        # It takes spare slots when it starts instead.
+        slots = 1
+    slots, memory = resources(description, outputs, slots, memory)
+
+    async with job_slot(priority(description, outputs, critical), slots, memory) as track, (spare_slots() if uses_jobs else contextlib.nullcontext(0)) as spare:
+        if isinstance(command, list):
+            command = format_command(command, working_directory, jobs=spare + 1)
+            if shell:
+                command = " ".join(command)
+        else:
+            shell = True
+        command_string = command if shell else shlex.join(command)
+        start_time = trace.now()
+        try:
+            env = shared_semaphore.environment() if use_jobserver and isinstance(shared_semaphore, jobserver.Jobserver) else None
+            result = await process.run(command, working_directory, shell=shell, env=env, output=output, on_line=_log_line)
+        finally:
+            if state is not None:
+                state.changed()
+            end_time = trace.now()
+        result.track = track
+        result.start_time = start_time
+        result.end_time = end_time
+        args = {"command": command_string, "exit_code": result.returncode}
+        if result.rusage is not None:
+            args.update({"user_time": result.rusage.ru_utime, "system_time": result.rusage.ru_stime})
+        if result.max_memory is not None:
+            args["max_rss_kb"] = result.max_memory // 1024
+        if uses_jobs:
+            args["jobs"] = spare + 1
+        if slots > 1:
+            args["slots"] = slots
+        if trace_args:
+            args.update(trace_args)
+        _trace_step(command_string if not description else description, track, start_time, end_time, args, inputs, outputs)
 
     working_directory = working_directory.relative_to(pathlib.Path.cwd())
-    command = f"{working_directory}$ {command}"
+    command_string = f"{working_directory}$ {command_string}"
 
-    if process.returncode == 0:
+    if result.returncode == 0:
+        record_duration(description, outputs, start_time, end_time, result.rusage, result.max_memory)
         if description:
             logger.info(description)
-            logger.debug(command)
+            logger.debug(command_string)
         else:
-            logger.info(command)
+            logger.info(command_string)
     else:
-        if stdout:
-            logger.info(stdout.decode("utf-8").strip())
-        if stderr:
-            logger.warning(stderr.decode("utf-8").strip())
-        if not stdout and not stderr:
-            logger.warning("No output")
-        logger.error(command)
+        log_failure(result.output, command_string)
         raise RuntimeError()
+    return result
 
-async def run_function(function, positional, named, description=None,):
-    async with shared_semaphore:
-        track = tracks.pop()
-        start_time = time.perf_counter_ns() // 1000
-        result = await asyncio.to_thread(function, *positional, **named)
+def log_failure(output, command_string):
+    """Log the output of a failed command, given as (stream name, line) tuples."""
+    stdout = "\n".join(line for name, line in output if name == "stdout")
+    stderr = "\n".join(line for name, line in output if name == "stderr")
+    if stdout:
+        logger.info(stdout.strip())
+    if stderr:
+        logger.warning(stderr.strip())
+    if not stdout and not stderr:
+        logger.warning("No output")
+    logger.error(command_string)
 
-        end_time = time.perf_counter_ns() // 1000
-        trace_entries.append({"name": str(function) if not description else description, "ph": "X", "pid": 0, "tid": track, "ts": start_time, "dur": end_time - start_time})
-        tracks.append(track)
+def get_process_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """Worker processes to pass to run_function() as its executor.
+
+    Workers are forked, so ask for them before starting work in threads. Forking a process
+    whose other threads hold locks can leave the child stuck on them.
+    """
+    global process_pool
+    if process_pool is None:
+        # Fork where we can because spawned workers run the build script again, and build scripts
+        # don't usually guard with __name__ == "__main__". Workers only run the given function.
+        method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        process_pool = concurrent.futures.ProcessPoolExecutor(slot_count, mp_context=multiprocessing.get_context(method))
+        if method == "fork":
+            # Fork all of the workers now rather than as work arrives, when more threads are about.
+            process_pool.submit(int)
+    return process_pool
+
+async def run_function(function, positional, named, description=None, inputs=(), outputs=(), trace_args=None, critical=False, executor=None):
+    """Run function in a thread, or on executor if given, while holding a job slot."""
+    async with job_slot(priority(description, outputs, critical)) as track:
+        start_time = trace.now()
+        try:
+            if executor is None:
+                result = await asyncio.to_thread(function, *positional, **named)
+            else:
+                result = await asyncio.get_running_loop().run_in_executor(executor, functools.partial(function, *positional, **named))
+        finally:
+            if state is not None:
+                state.changed()
+            end_time = trace.now()
+        args = {"function": getattr(function, "__qualname__", str(function))}
+        if trace_args:
+            args.update(trace_args)
+        _trace_step(str(function) if not description else description, track, start_time, end_time, args, inputs, outputs)
 
     if description:
         logger.info(description)
@@ -101,6 +488,8 @@ async def run_function(function, positional, named, description=None,):
     return result
 
 def run_in_thread(function):
+    @functools.wraps(function)
     def wrapper(*positional, **named):
         return run_function(function, positional, named)
     return wrapper
+
@@ -0,0 +1,199 @@
+import errno
+import fcntl
+import functools
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import uuid
+
+from . import depfile
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 * 1024 * 1024
+
+# From linux/fs.h. Clones a file's extents on filesystems that support it (btrfs, xfs).
+FICLONE = 0x40049409
+
+def default_directory() -> pathlib.Path:
+    if "EMBEDDED_BUILD_CACHE" in os.environ:
+        return pathlib.Path(os.environ["EMBEDDED_BUILD_CACHE"])
+    root = os.environ.get("XDG_CACHE_HOME", pathlib.Path.home() / ".cache")
+    return pathlib.Path(root) / "embedded-build"
+
+@functools.cache
+def tool_identity(executable: str) -> str:
+    """Identify a tool by its resolved path, size and modification time."""
+    path = shutil.which(executable) or executable
+    path = os.path.realpath(path)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return path
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+# Headers are shared by many translation units so remember their hashes.
+_file_hashes = {}
+
+def hash_file(path: pathlib.Path) -> str:
+    stat = os.stat(path)
+    key = str(path)
+    cached = _file_hashes.get(key)
+    if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+    with open(path, "rb") as f:
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+    _file_hashes[key] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+def clone_file(source: pathlib.Path, destination: pathlib.Path):
+    """Make destination a copy of source by reflink where possible, otherwise by copying.
+
+    Never a hardlink: compilers rewrite their outputs in place, which would change the cache
+    entry sharing the file too.
+    """
+    destination.unlink(missing_ok=True)
+    try:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return
+    except OSError:
+        destination.unlink(missing_ok=True)
+    shutil.copyfile(source, destination)
+
+class ObjectCache:
+    """Content addressed store of compiler outputs.
+
+    Lookups happen in two steps. The command, compiler and source select a manifest that lists
+    the inputs from the last dependency file. The hashes of those inputs then select the stored
+    outputs. Entries are evicted least recently used first once the store exceeds max_size.
+    """
+    def __init__(self, directory: pathlib.Path = None, max_size: int = 5 * GB):
+        if directory is None:
+            directory = default_directory() / "objects"
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self._size = None
+
+    def base_key(self, command: list[str], source_file: pathlib.Path, extra_inputs=()) -> str:
+        h = hashlib.sha256()
+        h.update(tool_identity(command[0]).encode("utf-8"))
+        h.update(b"\0")
+        h.update(json.dumps(command).encode("utf-8"))
+        h.update(b"\0")
+        h.update(hash_file(source_file).encode("utf-8"))
+        # Inputs, such as a precompiled header, that may not be listed in the dependency file.
+        for path in extra_inputs:
+            h.update(b"\0")
+            h.update(hash_file(path).encode("utf-8"))
+        return h.hexdigest()
+
+    def _manifest_path(self, base_key):
+        return self.directory / "manifests" / base_key[:2] / base_key
+
+    def _entry_path(self, key):
+        return self.directory / "entries" / key[:2] / key
+
+    def _full_key(self, base_key, inputs, working_directory):
+        h = hashlib.sha256(base_key.encode("utf-8"))
+        for i in inputs:
+            path = pathlib.Path(i)
+            if not path.is_absolute():
+                path = working_directory / path
+            h.update(b"\0")
+            h.update(i.encode("utf-8"))
+            h.update(b"\0")
+            h.update(hash_file(path).encode("utf-8"))
+        return h.hexdigest()
+
+    def lookup(self, base_key: str, working_directory: pathlib.Path) -> str:
+        """Return the key of a matching entry or None."""
+        try:
+            inputs = json.loads(self._manifest_path(base_key).read_text())
+            key = self._full_key(base_key, inputs, working_directory)
+        except (OSError, ValueError):
+            return None
+        if not self._entry_path(key).is_dir():
+            return None
+        return key
+
+    def restore(self, key: str, outputs: list[pathlib.Path]) -> bool:
+        entry = self._entry_path(key)
+        try:
+            for i, output in enumerate(outputs):
+                clone_file(entry / str(i), output)
+            # The entry's own timestamp tracks recency.
+            os.utime(entry)
+        except OSError:
+            logger.debug("Failed to restore %s", key, exc_info=True)
+            return False
+        return True
+
+    def store(self, base_key: str, dependency_file: pathlib.Path, outputs: list[pathlib.Path], working_directory: pathlib.Path):
+        inputs = [str(p) for p in depfile.parse(dependency_file)]
+        key = self._full_key(base_key, inputs, working_directory)
+        entry = self._entry_path(key)
+        if not entry.is_dir():
+            temporary = entry.with_name(entry.name + "." + uuid.uuid4().hex)
+            temporary.mkdir(parents=True)
+            size = 0
+            for i, output in enumerate(outputs):
+                clone_file(output, temporary / str(i))
+                size += output.stat().st_size
+            try:
+                temporary.rename(entry)
+            except OSError as e:
+                # Another build stored the same entry first.
+                shutil.rmtree(temporary, ignore_errors=True)
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+            else:
+                self._add_size(size)
+
+        manifest = self._manifest_path(base_key)
+        manifest.parent.mkdir(parents=True, exist_ok=True)
+        temporary = manifest.with_name(manifest.name + "." + uuid.uuid4().hex)
+        temporary.write_text(json.dumps(inputs))
+        temporary.replace(manifest)
+
+    def _entries(self):
+        entries = self.directory / "entries"
+        if not entries.is_dir():
+            return
+        for bucket in entries.iterdir():
+            for entry in bucket.iterdir():
+                if "." in entry.name:
+                    continue
+                yield entry
+
+    def _entry_size(self, entry):
+        return sum(f.stat().st_size for f in entry.iterdir())
+
+    def _add_size(self, size):
+        if self._size is None:
+            self._size = sum(self._entry_size(e) for e in self._entries())
+        else:
+            self._size += size
+        if self._size > self.max_size:
+            self.prune()
+
+    def prune(self, target_size: int = None):
+        """Evict least recently used entries until the store is under target_size."""
+        if target_size is None:
+            target_size = self.max_size * 9 // 10
+        entries = []
+        total = 0
+        for entry in self._entries():
+            size = self._entry_size(entry)
+            entries.append((entry.stat().st_mtime_ns, size, entry))
+            total += size
+        entries.sort()
+        for _, size, entry in entries:
+            if total <= target_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+        self._size = total
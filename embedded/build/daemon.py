@@ -0,0 +1,258 @@
+"""Keep a build warm in memory between runs.
+
+The daemon builds, then watches the files the build used and builds again when they change.
+Everything the build script set up, such as resolved CPUs and microcontrollers with their parsed
+SVD devices, and the record of each step's inputs stay loaded. Running the same build script
+again while the daemon is up asks it to build over a Unix socket, with its log output and exit
+status passed back, instead of starting from scratch.
+
+Messages use the framing of embedded.build.remote.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import pathlib
+import socket
+import stat
+import struct
+import sys
+import tempfile
+
+from embedded import build
+from . import cache
+from . import remote
+from . import watch
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait after a change for the rest of an editor's writes before building.
+SETTLE_TIME = 0.1
+
+def _private_directory() -> pathlib.Path:
+    """A directory only we can use, for sockets that don't fit in the state directory."""
+    if "XDG_RUNTIME_DIR" in os.environ:
+        directory = pathlib.Path(os.environ["XDG_RUNTIME_DIR"]) / "embedded-build"
+    else:
+        directory = pathlib.Path(tempfile.gettempdir()) / f"embedded-build-{os.getuid()}"
+    directory.mkdir(mode=0o700, exist_ok=True)
+    # Someone else may have made it first, in a shared temporary directory.
+    info = directory.lstat()
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise RuntimeError(f"{directory} isn't a private directory of ours")
+    return directory
+
+def socket_path() -> pathlib.Path:
+    path = build.state_directory / "daemon.sock"
+    # Unix socket paths are limited to about 100 bytes.
+    if len(os.fsencode(path)) > 100:
+        digest = hashlib.sha256(os.fsencode(path)).hexdigest()[:16]
+        path = _private_directory() / f"{digest}.sock"
+    return path
+
+def _peer_is_us(writer) -> bool:
+    """Whether the other end of a Unix socket runs as our user."""
+    sock = writer.get_extra_info("socket")
+    if not hasattr(socket, "SO_PEERCRED") or sock is None:
+        return False
+    credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", credentials)
+    return uid == os.getuid()
+
+def _hash(path):
+    try:
+        return cache.hash_file(path)
+    except OSError:
+        return None
+
+class _Forward(logging.Handler):
+    """Passes log records to a client as (level, logger name, message)."""
+    def __init__(self, records: asyncio.Queue):
+        super().__init__()
+        self.records = records
+        self.loop = asyncio.get_running_loop()
+
+    def emit(self, record):
+        # Steps in threads log too.
+        self.loop.call_soon_threadsafe(self.records.put_nowait, (record.levelno, record.name, self.format(record)))
+
+class Daemon:
+    def __init__(self, build_function, arguments: list[str], script_files: list[pathlib.Path]):
+        """build_function is called with no arguments for each build and returns a coroutine.
+
+        arguments identify the build so that only runs asking for the same one are served.
+        script_files are the build script and its modules. The daemon stops to be started again
+        when they change.
+        """
+        self.build_function = build_function
+        self.arguments = arguments
+        self.directory = os.getcwd()
+        self.script_files = {str(path): _hash(path) for path in script_files}
+        self.watcher = watch.watcher()
+        self.lock = asyncio.Lock()
+        self.restart = False
+
+    def _script_changed(self, paths=None) -> bool:
+        return any(_hash(path) != digest for path, digest in self.script_files.items() if paths is None or path in paths)
+
+    def _stale(self) -> bool:
+        """Whether a source of the last build has different contents now."""
+        changes = self.watcher.accumulated()
+        if changes is None:
+            return True
+        if self._script_changed(changes):
+            self.restart = True
+            return False
+        state = build.state
+        outputs = set()
+        inputs = set()
+        for _, step_outputs, step_inputs in state.steps.values():
+            outputs.update(step_outputs)
+            inputs.update(step_inputs)
+        # Steps write their outputs and generated files are rewritten with the same contents, so
+        # only changed contents count.
+        for path in changes:
+            if path in inputs and path not in outputs:
+                recorded = state.files.get(path)
+                if recorded is None or _hash(path) != recorded[1]:
+                    return True
+        return False
+
+    async def build(self, records=None) -> int:
+        """Build once and return the exit status. Log records go to the records queue if given."""
+        async with self.lock:
+            handler = None
+            if records is not None:
+                handler = _Forward(records)
+                logging.getLogger().addHandler(handler)
+            # Changes from here on are picked up by this build or start another.
+            self.watcher.accumulated()
+            build.generation += 1
+            build.state.watch(self.watcher)
+            build.start_trace()
+            try:
+                await self.build_function()
+                returncode = 0
+            except RuntimeError as e:
+                # Failed commands have already logged why.
+                if str(e):
+                    logger.error(e)
+                returncode = 1
+            except Exception:
+                logger.exception("Build failed")
+                returncode = 1
+            finally:
+                build.save_state()
+                build.close_trace()
+                if handler is not None:
+                    logging.getLogger().removeHandler(handler)
+            self.watcher.watch(self.script_files)
+            self.watcher.watch(build.state.files)
+            return returncode
+
+    async def _send(self, records, writer):
+        while (record := await records.get()) is not None:
+            await remote.write_message(writer, {"log": record})
+
+    async def handle(self, reader, writer):
+        try:
+            request, _ = await remote.read_message(reader)
+            if request is None:
+                return
+            if request.get("arguments") != self.arguments or request.get("directory") != self.directory:
+                await remote.write_message(writer, {"error": f"The build daemon is running {' '.join(self.arguments)} in {self.directory}"})
+                return
+            if self._script_changed():
+                await remote.write_message(writer, {"error": "The build script changed"})
+                return
+            records = asyncio.Queue()
+            sender = asyncio.ensure_future(self._send(records, writer))
+            returncode = await self.build(records)
+            # After the records the handler has scheduled.
+            asyncio.get_running_loop().call_soon(records.put_nowait, None)
+            await sender
+            await remote.write_message(writer, {"returncode": returncode})
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            logger.debug("Lost build client", exc_info=True)
+        finally:
+            writer.close()
+
+    async def run(self):
+        """Build, then build again on changes and requests until the build script changes."""
+        path = socket_path()
+        try:
+            _, writer = await asyncio.open_unix_connection(path)
+            writer.close()
+            raise RuntimeError(f"A build daemon is already running at {path}")
+        except OSError:
+            pass
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.unlink(missing_ok=True)
+        server = await asyncio.start_unix_server(self.handle, path)
+        os.chmod(path, 0o600)
+        try:
+            await self.build()
+            logger.info(f"Watching for changes. Builds of the same script use {path}")
+            while not self.restart:
+                await self.watcher.wait()
+                await asyncio.sleep(SETTLE_TIME)
+                if self._stale():
+                    await self.build()
+            logger.info("The build script changed, restarting")
+        finally:
+            server.close()
+            path.unlink(missing_ok=True)
+            self.watcher.close()
+
+def _start_again():
+    # exec doesn't run exit handlers.
+    build.save_state()
+    build.close_trace()
+    build.close_process_pool()
+    build.close_jobserver()
+    os.execv(sys.executable, [sys.executable, *sys.orig_argv[1:]])
+
+async def serve(build_function, arguments, script_files):
+    daemon = Daemon(build_function, arguments, script_files)
+    await daemon.run()
+    if daemon.restart:
+        _start_again()
+
+async def request(arguments: list[str]):
+    """Have a running daemon build. Returns its exit status or None if no daemon is running this build."""
+    try:
+        path = socket_path()
+    except RuntimeError as e:
+        logger.warning(f"Building without the daemon: {e}")
+        return None
+    if not path.exists():
+        return None
+    try:
+        reader, writer = await asyncio.open_unix_connection(path)
+    except OSError:
+        return None
+    if not _peer_is_us(writer):
+        logger.warning(f"Building without the daemon: {path} isn't served by our user")
+        writer.close()
+        return None
+    try:
+        await remote.write_message(writer, {"op": "build", "arguments": arguments, "directory": os.getcwd()})
+        while True:
+            reply, _ = await remote.read_message(reader)
+            if reply is None:
+                logger.error("The build daemon went away")
+                return 1
+            if "error" in reply:
+                logger.info(f"Building without the daemon: {reply['error']}")
+                return None
+            if "log" in reply:
+                level, name, message = reply["log"]
+                logging.getLogger(name).log(level, message)
+            elif "returncode" in reply:
+                return reply["returncode"]
+    except (OSError, asyncio.IncompleteReadError, ValueError):
+        logger.error("Lost the build daemon", exc_info=True)
+        return 1
+    finally:
+        writer.close()
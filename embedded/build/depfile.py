@@ -0,0 +1,38 @@
+import pathlib
+
+def parse(path: pathlib.Path, directory: pathlib.Path = None) -> list[pathlib.Path]:
+    """Return the prerequisites listed in a make style dependency file (as written by -MMD)."""
+    text = path.read_text()
+    # Join continued lines and split off the target.
+    text = text.replace("\\\r\n", " ").replace("\\\n", " ")
+    _, _, text = text.partition(": ")
+    dependencies = []
+    current = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == "\\" and i + 1 < len(text) and text[i + 1] in " #":
+            current.append(text[i + 1])
+            i += 2
+            continue
+        if c == "$" and i + 1 < len(text) and text[i + 1] == "$":
+            current.append("$")
+            i += 2
+            continue
+        if c.isspace():
+            if current:
+                dependencies.append("".join(current))
+                current = []
+        else:
+            current.append(c)
+        i += 1
+    if current:
+        dependencies.append("".join(current))
+
+    paths = []
+    for dependency in dependencies:
+        dependency = pathlib.Path(dependency)
+        if directory is not None and not dependency.is_absolute():
+            dependency = directory / dependency
+        paths.append(dependency)
+    return paths
@@ -0,0 +1,93 @@
+import logging
+import os
+import pathlib
+import pickle
+
+logger = logging.getLogger(__name__)
+
+VERSION = 2
+
+# Weight of the latest run in a step's smoothed duration.
+SMOOTHING = 0.5
+
+class History:
+    """Persistent record of how long past build steps took and what they used.
+
+    Steps are keyed by their first output, or their description when they don't have one, so
+    that the same step is found again even when its command line changes. Durations and CPU use
+    are smoothed across runs so one slow run doesn't dominate.
+    """
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.steps = {}
+        self.dirty = False
+        self._typical = {}
+        try:
+            with path.open("rb") as f:
+                version, self.steps = pickle.load(f)
+            if version != VERSION:
+                self.steps = {}
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.warning(f"Ignoring unreadable build history {path}")
+
+    @staticmethod
+    def key(outputs=(), description=None) -> str:
+        if outputs:
+            return os.path.abspath(outputs[0])
+        return description
+
+    def value(self, key, field, default=None):
+        """Smoothed field of the step, such as "duration", "cpus" or "memory", or default if it isn't known."""
+        step = self.steps.get(key)
+        if step is None:
+            return default
+        return step.get(field, default)
+
+    def duration(self, key, default=None):
+        """Smoothed duration of the step in seconds or default if it hasn't run before."""
+        return self.value(key, "duration", default)
+
+    def typical(self, field, default=0):
+        """Median field of the steps seen so far that have it, used for steps that haven't run before."""
+        if field not in self._typical:
+            values = sorted(step[field] for step in self.steps.values() if field in step)
+            self._typical[field] = values[len(values) // 2] if values else None
+        result = self._typical[field]
+        return default if result is None else result
+
+    def typical_duration(self):
+        return self.typical("duration")
+
+    def record(self, key, duration, cpu_time=None, memory=None):
+        """Record a run of the step. cpu_time is the seconds it spent on CPUs and memory its peak
+        size in bytes, when they're known.
+        """
+        if key is None:
+            return
+        step = self.steps.get(key)
+        if step is None:
+            step = self.steps[key] = {"duration": duration}
+        else:
+            step["duration"] += SMOOTHING * (duration - step["duration"])
+        if cpu_time is not None and duration > 0:
+            cpus = cpu_time / duration
+            step["cpus"] = step["cpus"] + SMOOTHING * (cpus - step["cpus"]) if "cpus" in step else cpus
+        if memory is not None:
+            # Grows at once, so a single large run holds back others, and shrinks gradually.
+            previous = step.get("memory")
+            step["memory"] = memory if previous is None or memory > previous else previous + SMOOTHING * (memory - previous)
+        self.dirty = True
+        # The medians move with each run, which matters to a daemon that builds again and again.
+        self._typical.clear()
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_name(self.path.name + ".tmp")
+        with temporary.open("wb") as f:
+            pickle.dump((VERSION, self.steps), f, protocol=pickle.HIGHEST_PROTOCOL)
+        temporary.replace(self.path)
+        self.dirty = False
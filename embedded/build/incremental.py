@@ -0,0 +1,135 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import pickle
+
+from . import cache
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+class State:
+    """Persistent record of each step's command line, inputs and outputs.
+
+    Files are shared between steps (headers especially) so each one is recorded once with its
+    modification time and content hash. A file whose mtime changed but whose content didn't is
+    still up to date.
+    """
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.files = {}
+        self.steps = {}
+        self.dirty = False
+        # Results of checking files during this run. Cleared whenever a step runs because it may
+        # have changed files we've already looked at.
+        self._checked = {}
+        # With a reliable watch.Watcher, files it covers and hasn't reported since they were last
+        # checked are trusted without looking at them again.
+        self.watcher = None
+        self._trusted = set()
+        try:
+            with path.open("rb") as f:
+                version, self.files, self.steps = pickle.load(f)
+            if version != VERSION:
+                self.files = {}
+                self.steps = {}
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.warning(f"Ignoring unreadable build state {path}")
+
+    @staticmethod
+    def _command_digest(command):
+        return hashlib.sha256(json.dumps(command).encode("utf-8")).hexdigest()
+
+    def _unchanged(self, path: str) -> bool:
+        result = self._checked.get(path)
+        if result is not None:
+            return result
+        if path in self._trusted:
+            return True
+        recorded = self.files.get(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if recorded is None or mtime is None:
+            result = False
+        elif mtime == recorded[0]:
+            result = True
+        else:
+            result = cache.hash_file(path) == recorded[1]
+            if result:
+                self.files[path] = (mtime, recorded[1])
+                self.dirty = True
+        self._checked[path] = result
+        return result
+
+    def up_to_date(self, outputs: list[pathlib.Path], command: list[str]) -> bool:
+        self._forget_changes()
+        step = self.steps.get(os.path.abspath(outputs[0]))
+        if step is None or step[0] != self._command_digest(command):
+            return False
+        for path in step[1]:
+            if not self._unchanged(path):
+                return False
+        for path in step[2]:
+            if not self._unchanged(path):
+                return False
+        return True
+
+    def record(self, outputs: list[pathlib.Path], command: list[str], inputs: list[pathlib.Path]):
+        outputs = tuple(os.path.abspath(p) for p in outputs)
+        inputs = tuple(os.path.abspath(p) for p in inputs)
+        for path in outputs + inputs:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                self.files[path] = (mtime, cache.hash_file(path))
+            except OSError:
+                self.files.pop(path, None)
+            self._checked.pop(path, None)
+        self.steps[outputs[0]] = (self._command_digest(command), outputs, inputs)
+        self.dirty = True
+
+    def _untrust(self, changes):
+        if changes is None:
+            self._trusted.clear()
+        else:
+            self._trusted.difference_update(changes)
+
+    def _forget_changes(self):
+        # The watcher tells _untrust() about everything it collects, whoever asks.
+        if self.watcher is not None and self._trusted:
+            self.watcher.changes()
+
+    def watch(self, watcher):
+        """Watch the recorded files and trust those that are unchanged. Call before each build."""
+        if self.watcher is not watcher:
+            watcher.listeners.append(self._untrust)
+            self.watcher = watcher
+        self._forget_changes()
+        self._checked.clear()
+        watcher.watch(self.files)
+        if not watcher.reliable:
+            return
+        # Only checked after the watch is in place so a change can't slip between the two.
+        for path in list(self.files):
+            if path not in self._trusted and watcher.covers(path) and self._unchanged(path):
+                self._trusted.add(path)
+
+    def changed(self):
+        """Forget the files checked so far because a step may have modified them."""
+        self._checked.clear()
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_name(self.path.name + ".tmp")
+        with temporary.open("wb") as f:
+            pickle.dump((VERSION, self.files, self.steps), f, protocol=pickle.HIGHEST_PROTOCOL)
+        temporary.replace(self.path)
+        self.dirty = False
@@ -0,0 +1,100 @@
+import array
+import asyncio
+import collections
+import fcntl
+import os
+import shutil
+import tempfile
+import termios
+
+class Jobserver:
+    """Job slots shared with external tools through a GNU make style jobserver fifo.
+
+    Each byte in the fifo is a free slot. Python jobs take a slot by reading a byte and return it
+    by writing one back, so this works as a drop in replacement for the shared semaphore. A tool
+    started by a job runs in that job's slot and reads any additional slots from the fifo named
+    in MAKEFLAGS, just like make's own children do.
+    """
+    def __init__(self, job_count: int):
+        self.job_count = job_count
+        self._directory = tempfile.mkdtemp(prefix="embedded-jobserver-")
+        self.path = os.path.join(self._directory, "fifo")
+        os.mkfifo(self.path, 0o600)
+        # Open the read end first so that opening the write end doesn't fail.
+        self._read_fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        self._write_fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        os.write(self._write_fd, b"+" * job_count)
+        self._waiters = collections.deque()
+
+    @property
+    def makeflags(self) -> str:
+        return f"-j{self.job_count} --jobserver-auth=fifo:{self.path}"
+
+    def environment(self) -> dict:
+        """Our environment with the jobserver added to MAKEFLAGS, after any flags already there.
+
+        Only give this to tools that understand fifo jobservers, such as ninja 1.13 and make 4.4.
+        Older make stops with an error when it sees one.
+        """
+        environment = dict(os.environ)
+        makeflags = environment.get("MAKEFLAGS")
+        environment["MAKEFLAGS"] = f"{makeflags} {self.makeflags}" if makeflags else self.makeflags
+        return environment
+
+    def available(self) -> int:
+        """Number of free slots right now."""
+        count = array.array("i", [0])
+        fcntl.ioctl(self._read_fd, termios.FIONREAD, count)
+        return count[0]
+
+    def locked(self) -> bool:
+        return self.available() == 0
+
+    def _take(self) -> bool:
+        try:
+            return len(os.read(self._read_fd, 1)) == 1
+        except BlockingIOError:
+            return False
+
+    def _on_readable(self):
+        while self._waiters:
+            waiter = self._waiters[0]
+            if waiter.done():
+                self._waiters.popleft()
+                continue
+            if not self._take():
+                return
+            self._waiters.popleft()
+            waiter.set_result(None)
+        asyncio.get_running_loop().remove_reader(self._read_fd)
+
+    async def acquire(self):
+        if not self._waiters and self._take():
+            return True
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        if not self._waiters:
+            loop.add_reader(self._read_fd, self._on_readable)
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # We may have been handed a slot just before being cancelled.
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        return True
+
+    def release(self):
+        os.write(self._write_fd, b"+")
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+        shutil.rmtree(self._directory, ignore_errors=True)
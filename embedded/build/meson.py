@@ -1,9 +1,18 @@
+import asyncio
 import embedded
+import hashlib
 import inspect
-from . import run_command, capture_caller_directory
+import json
+import logging
+import os
+from . import cache, run_command, capture_caller_directory
 from embedded.cpu import arm, riscv
 import pathlib
 
+logger = logging.getLogger(__name__)
+
+MESON_FILES = ("meson.build", "meson_options.txt", "meson.options")
+
 def create_cross_file(cpu: embedded.CPU, compiler: embedded.Compiler):
     cflags = ",".join(f"'{flag}'" for flag in cpu.get_arch_cflags(compiler))
     link_flags = cflags
@@ -32,14 +41,35 @@ c_args = [{cflags}]
 c_link_args = [{link_flags}]
 """
 
+def _fingerprint(source_dir, cross_file_content, options, compiler) -> str:
+    """Hash of everything that affects a meson setup: the cross file, options, meson files and tools."""
+    h = hashlib.sha256()
+    h.update(cross_file_content.encode("utf-8"))
+    h.update(json.dumps(options, sort_keys=True, default=str).encode("utf-8"))
+    for tool in ("meson", compiler.c_compiler, compiler.cpp_compiler, compiler.ar, compiler.strip):
+        h.update(cache.tool_identity(tool).encode("utf-8"))
+    for directory, directories, files in os.walk(source_dir):
+        directories[:] = sorted(d for d in directories if not d.startswith("."))
+        for name in sorted(files):
+            if name in MESON_FILES:
+                path = os.path.join(directory, name)
+                h.update(path.encode("utf-8"))
+                h.update(cache.hash_file(path).encode("utf-8"))
+    return h.hexdigest()
+
 @capture_caller_directory
 async def setup(source_dir, build_dir, cpu: embedded.CPU, compiler: embedded.Compiler, reconfigure=True, options=[], caller_directory = None):
+    """Configure build_dir with meson unless nothing that affects the configuration has changed."""
     cmd = ["meson", "setup"]
     if reconfigure:
         cmd.append("--reconfigure")
 
+    build_dir.mkdir(parents=True, exist_ok=True)
     cross_file = build_dir / "cross_file.txt"
-    cross_file.write_text(create_cross_file(cpu, compiler))
+    cross_file_content = create_cross_file(cpu, compiler)
+    # Leave an unchanged cross file alone because meson reconfigures when it's touched.
+    if not cross_file.exists() or cross_file.read_text() != cross_file_content:
+        cross_file.write_text(cross_file_content)
     cmd.append("--cross-file")
     cmd.append(str(cross_file))
 
@@ -54,4 +84,13 @@ async def setup(source_dir, build_dir, cpu: embedded.CPU, compiler: embedded.Com
     cmd.append(source_dir)
     cmd.append(build_dir)
 
+    fingerprint_file = build_dir / "embedded-setup.sha256"
+    fingerprint = await asyncio.to_thread(_fingerprint, caller_directory / source_dir, cross_file_content, options, compiler)
+    configured = (build_dir / "build.ninja").exists()
+    if configured and fingerprint_file.exists() and fingerprint_file.read_text() == fingerprint:
+        logger.debug(f"meson setup {build_dir} (up to date)")
+        return
+
+    fingerprint_file.unlink(missing_ok=True)
     await run_command(cmd, caller_directory=caller_directory)
+    fingerprint_file.write_text(fingerprint)
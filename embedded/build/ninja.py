@@ -1,17 +1,102 @@
-from embedded import build
+import asyncio
+import functools
+import os
+import pathlib
+import shlex
+import subprocess
 
-async def run(build_dir):
-	extra_parallel = 0
-	while not build.shared_semaphore.locked():
-		extra_parallel += 1
-		# Await even though we should get it immediately.
-		await build.shared_semaphore.acquire()
-	# Release one for run command
-	build.shared_semaphore.release()
-	extra_parallel -= 1
+from embedded import build
+from embedded.build import jobserver
 
+@functools.cache
+def _supports_jobserver():
+	"""Ninja takes slots from a jobserver fifo starting with 1.13."""
 	try:
-		await build.run_command(["ninja", "-j", str(extra_parallel + 1)], working_directory=build_dir)
-	finally:
-		for i in range(extra_parallel):
-			build.shared_semaphore.release()
+		version = subprocess.run(["ninja", "--version"], capture_output=True, text=True).stdout
+		return tuple(int(x) for x in version.strip().split(".")[:2]) >= (1, 13)
+	except (OSError, ValueError):
+		return False
+
+async def run(build_dir, build_file=None):
+	"""Run ninja in build_dir, on build_file if given rather than build_dir/build.ninja."""
+	command = ["ninja"]
+	if build_file is not None:
+		command.extend(["-f", build_file])
+	if isinstance(build.shared_semaphore, jobserver.Jobserver) and await asyncio.to_thread(_supports_jobserver):
+		# Ninja runs in our slot and takes more from the jobserver as they free up, so the CPU
+		# time of its children isn't its own.
+		await build.run_command(command, working_directory=build_dir, slots=1, use_jobserver=True)
+		return
+
+	# Ninja runs in our slot plus whichever are free when it starts.
+	await build.run_command([*command, "-j", build.Jobs()], working_directory=build_dir)
+
+def _escape(path):
+	return str(path).replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+
+class Recorder:
+	"""Collects the commands of a build, instead of running them, to write out as a ninja file.
+
+	Ninja runs from root, the directory of the build script, so that relative paths in
+	dependency files resolve the same way for it as they did for the compiler. Commands that
+	run somewhere else change directory first.
+	"""
+	def __init__(self, path, root):
+		self.path = pathlib.Path(path)
+		self.root = pathlib.Path(root)
+		self.edges = []
+
+	def _relative(self, path, working_directory):
+		return _escape(os.path.relpath(pathlib.Path(working_directory, path), self.root))
+
+	def add(self, command, working_directory, description, inputs, outputs):
+		command_string = command if isinstance(command, str) else shlex.join(command)
+		if pathlib.Path(working_directory) != self.root:
+			command_string = f"cd {shlex.quote(str(working_directory))} && {command_string}"
+		# Ninja reads and then deletes dependency files so they aren't outputs of the edge.
+		depfile = None
+		for output in outputs:
+			if str(output).endswith(".d"):
+				depfile = self._relative(output, working_directory)
+		outputs = [self._relative(o, working_directory) for o in outputs if not str(o).endswith(".d")]
+		inputs = [self._relative(i, working_directory) for i in inputs]
+		self.edges.append((command_string, description or command_string, inputs, outputs, depfile))
+
+	def write(self, regenerate_command, regenerate_directory, regenerate_inputs):
+		"""Write the ninja file with an edge that regenerates it when regenerate_inputs change."""
+		lines = [
+			"# Generated by embedded.build. Edit the build script instead.",
+			"ninja_required_version = 1.3",
+			f"builddir = {_escape(os.path.relpath(self.path.parent, self.root))}",
+			"",
+			"rule run",
+			"  command = $command",
+			"  description = $description",
+			"  restat = 1",
+			"",
+			"rule run_with_deps",
+			"  command = $command",
+			"  description = $description",
+			"  depfile = $depfile",
+			"  deps = gcc",
+			"  restat = 1",
+			"",
+			"rule regenerate",
+			"  command = $command",
+			"  description = Regenerating $out",
+			"  generator = 1",
+			"",
+		]
+		for command, description, inputs, outputs, depfile in self.edges:
+			lines.append(f"build {' '.join(outputs)}: {'run' if depfile is None else 'run_with_deps'} {' '.join(inputs)}")
+			lines.append(f"  command = {command.replace('$', '$$')}")
+			lines.append(f"  description = {description.replace('$', '$$')}")
+			if depfile is not None:
+				lines.append(f"  depfile = {depfile}")
+		lines.append(f"build {self._relative(self.path, self.root)}: regenerate {' '.join(self._relative(i, self.root) for i in regenerate_inputs)}")
+		lines.append(f"  command = cd {shlex.quote(str(regenerate_directory))} && {shlex.join(regenerate_command).replace('$', '$$')}")
+		lines.append("")
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		temporary = self.path.with_name(self.path.name + ".tmp")
+		temporary.write_text("\n".join(lines))
+		temporary.replace(self.path)
@@ -0,0 +1,156 @@
+import asyncio
+import collections
+import os
+import subprocess
+import sys
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Longest line kept from a process' output. Longer lines are replaced with a marker.
+LINE_LIMIT = 1024 * 1024
+# Seconds between samples of a running process' peak memory.
+MEMORY_SAMPLE_INTERVAL = 0.05
+# ru_maxrss is in kilobytes except on macOS.
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+class Result:
+    """Outcome of a finished process.
+
+    output holds the last lines written to stdout and stderr as (stream name, line) tuples.
+    rusage is the child's resource usage from wait4() or None where that isn't available.
+    max_memory is the peak resident size of the command itself in bytes, or None if unknown. It
+    isn't rusage's ru_maxrss, which counts our own memory from before the child exec'd.
+    track, start_time and end_time locate the process in the build trace once it's been run
+    as a build step.
+    """
+    def __init__(self, returncode, output, rusage, max_memory=None):
+        self.returncode = returncode
+        self.output = output
+        self.rusage = rusage
+        self.max_memory = max_memory
+        self.track = None
+        self.start_time = None
+        self.end_time = None
+
+    def lines(self, stream=None):
+        return [line for name, line in self.output if stream is None or name == stream]
+
+async def _read_lines(pipe, name, output, on_line):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=LINE_LIMIT)
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    try:
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                line = b"<line too long>\n"
+            if not line:
+                break
+            line = line.decode("utf-8", errors="replace").rstrip("\r\n")
+            output.append((name, line))
+            if on_line is not None:
+                on_line(name, line)
+    finally:
+        transport.close()
+
+def _high_water_mark(pid):
+    """Peak resident size in bytes of pid since it exec'd plus that of its running descendants,
+    such as gcc's cc1, or None if it can't be read.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            total = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+    except (OSError, ValueError, StopIteration):
+        return None
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return total
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children = f.read().split()
+        except OSError:
+            continue
+        for child in children:
+            total += _high_water_mark(child) or 0
+    return total
+
+async def _sample_memory(pid, peak):
+    while True:
+        sample = _high_water_mark(pid)
+        if sample is None:
+            return
+        peak[0] = max(peak[0] or 0, sample)
+        await asyncio.sleep(MEMORY_SAMPLE_INTERVAL)
+
+async def _wait(process):
+    """Reap process and return its wait status and resource usage."""
+    if not hasattr(os, "wait4"):
+        return await asyncio.to_thread(process.wait), None
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        # No pidfd so block a worker thread instead.
+        _, status, rusage = await asyncio.to_thread(os.wait4, process.pid, 0)
+        return status, rusage
+    exited = loop.create_future()
+    loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+    try:
+        await exited
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+    _, status, rusage = os.wait4(process.pid, 0)
+    return status, rusage
+
+async def run(command, working_directory, shell=False, env=None, output=None, on_line=None) -> Result:
+    """Run command and stream its output line by line.
+
+    command is an argv list that is executed directly unless shell is True, in which case it
+    must be a string. Lines are passed to on_line as they arrive and kept in output, a bounded
+    deque by default.
+    """
+    if output is None:
+        output = collections.deque(maxlen=1000)
+    # Popen execs directly (via vfork or posix_spawn where possible) when shell is False.
+    process = subprocess.Popen(
+        command,
+        shell=shell,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=working_directory,
+        env=env)
+    # The child's ru_maxrss includes our peak up to its exec because it started out as us.
+    own_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT if resource is not None else None
+    # Popen returns once the child has exec'd so samples are the command's own memory.
+    peak = [None]
+    sampler = asyncio.ensure_future(_sample_memory(process.pid, peak))
+    try:
+        await asyncio.gather(_read_lines(process.stdout, "stdout", output, on_line),
+                             _read_lines(process.stderr, "stderr", output, on_line))
+        # Stop before the pid is reaped and could be reused.
+        sampler.cancel()
+        status, rusage = await _wait(process)
+    except BaseException:
+        sampler.cancel()
+        process.kill()
+        process.wait()
+        raise
+    if rusage is None:
+        returncode = status
+    else:
+        returncode = os.waitstatus_to_exitcode(status)
+    # We reaped the child ourselves so let Popen know it's done.
+    process.returncode = returncode
+    max_memory = peak[0]
+    if rusage is not None and own_peak is not None and rusage.ru_maxrss * RSS_UNIT > own_peak:
+        # Above anything it could have inherited from us, so it's exactly the command's peak.
+        max_memory = rusage.ru_maxrss * RSS_UNIT
+    return Result(returncode, output, rusage, max_memory)
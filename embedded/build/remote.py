@@ -0,0 +1,376 @@
+"""Run build steps on worker processes, locally over Unix sockets or on other hosts over TCP.
+
+Start a worker with:
+
+    python -m embedded.build.remote --listen /tmp/worker.sock --jobs 8
+
+Every message is a 4 byte big endian length, a JSON header of that length and then the blobs
+whose sizes are listed in the header's "sizes". Inputs are uploaded once per worker, keyed by
+their sha256, and hardlinked into a fresh sandbox directory for each command. The least
+recently used inputs are dropped once they take more than --max-size.
+
+Workers only run the compilers they're given with --compiler, and only with arguments that stay
+inside the sandbox. Each connection starts with a hello carrying the token from the
+EMBEDDED_BUILD_TOKEN environment variable. TCP workers refuse to start without one and Unix
+socket workers are only reachable by their user.
+"""
+
+import argparse
+import asyncio
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import os
+import pathlib
+import re
+import shutil
+import struct
+import tempfile
+
+from . import cache
+from . import process
+
+logger = logging.getLogger(__name__)
+
+# Trace tracks of remote jobs start here so they don't collide with local ones.
+TRACK_BASE = 1000
+
+# Shared secret of workers and their clients.
+TOKEN_VARIABLE = "EMBEDDED_BUILD_TOKEN"
+
+# Compilers a worker runs unless told otherwise.
+DEFAULT_COMPILERS = ("clang", "clang++")
+
+# Options that load code or pick the programs the compiler runs.
+UNSAFE_OPTIONS = ("-fplugin", "-fpass-plugin", "-Xclang", "-B", "--ld-path", "-fuse-ld", "-Wl,", "-Xlinker", "-Xassembler",
+                  "-Wa,", "-Wp,", "-Xpreprocessor", "-specs", "--specs", "--gcc-toolchain", "--sysroot", "-load")
+
+_DIGEST = re.compile(r"[0-9a-f]{64}")
+
+executor = None
+
+class RemoteError(Exception):
+    """The worker couldn't be reached or misbehaved. The step can still be run locally."""
+
+async def read_message(reader) -> tuple[dict, list[bytes]]:
+    try:
+        length, = struct.unpack(">I", await reader.readexactly(4))
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None, []
+        raise
+    header = json.loads(await reader.readexactly(length))
+    blobs = [await reader.readexactly(size) for size in header.get("sizes", ())]
+    return header, blobs
+
+async def write_message(writer, header: dict, blobs=()):
+    header = dict(header, sizes=[len(blob) for blob in blobs])
+    encoded = json.dumps(header).encode("utf-8")
+    writer.write(struct.pack(">I", len(encoded)))
+    writer.write(encoded)
+    for blob in blobs:
+        writer.write(blob)
+    await writer.drain()
+
+async def _open(address):
+    if ":" in address and not address.startswith("/"):
+        host, _, port = address.rpartition(":")
+        return await asyncio.open_connection(host, int(port))
+    return await asyncio.open_unix_connection(address.removeprefix("unix:"))
+
+def _is_digest(digest) -> bool:
+    return isinstance(digest, str) and _DIGEST.fullmatch(digest) is not None
+
+def _check_argv(argv, compilers):
+    """Raise ValueError unless argv runs one of compilers on files in the sandbox."""
+    if not argv or argv[0] not in compilers:
+        raise ValueError(f"Not an allowed compiler: {argv[:1]}")
+    for part in argv[1:]:
+        if part.startswith(UNSAFE_OPTIONS):
+            raise ValueError(f"Option not allowed: {part}")
+        # Paths may be the whole argument, follow an = or be attached to a short option.
+        for path in (part, part.partition("=")[2], part[2:]):
+            if path.startswith("/") or ".." in pathlib.PurePosixPath(path).parts:
+                raise ValueError(f"Path outside the sandbox: {part}")
+
+def _sandbox_path(sandbox, relative):
+    path = pathlib.PurePosixPath(relative)
+    if path.is_absolute() or ".." in path.parts:
+        raise ValueError(f"Invalid sandbox path {relative}")
+    return sandbox / path
+
+class Worker:
+    """Serves upload and run requests from build clients."""
+    def __init__(self, directory: pathlib.Path, jobs: int, compilers=DEFAULT_COMPILERS, token=None, max_size: int = 5 * cache.GB):
+        self.directory = pathlib.Path(directory)
+        self.blobs = self.directory / "blobs"
+        self.blobs.mkdir(parents=True, exist_ok=True)
+        self.sandboxes = self.directory / "sandboxes"
+        self.sandboxes.mkdir(parents=True, exist_ok=True)
+        self.jobs = jobs
+        self.compilers = set(compilers)
+        self.token = token
+        self.semaphore = asyncio.Semaphore(jobs)
+        self.max_size = max_size
+        self._size = None
+
+    def _authorized(self, header) -> bool:
+        if self.token is None:
+            return True
+        token = header.get("token")
+        return isinstance(token, str) and hmac.compare_digest(token.encode("utf-8"), self.token.encode("utf-8"))
+
+    async def handle(self, reader, writer):
+        try:
+            header, _ = await read_message(reader)
+            if header is None:
+                return
+            if header.get("op") != "hello" or not self._authorized(header):
+                await write_message(writer, {"error": "Not authorized"})
+                return
+            await write_message(writer, {"jobs": self.jobs})
+            while True:
+                header, blobs = await read_message(reader)
+                if header is None:
+                    break
+                op = header["op"]
+                if op == "missing":
+                    if not all(_is_digest(h) for h in header["hashes"]):
+                        raise ValueError("Invalid hash")
+                    missing = [h for h in header["hashes"] if not self._touch(h)]
+                    await write_message(writer, {"hashes": missing})
+                elif op == "put":
+                    self._put(header["hash"], blobs[0])
+                    await write_message(writer, {})
+                elif op == "run":
+                    try:
+                        async with self.semaphore:
+                            reply, files = await self._run(header)
+                    except (OSError, ValueError) as e:
+                        # Most likely an input blob we don't have.
+                        reply, files = {"error": str(e)}, []
+                    await write_message(writer, reply, files)
+                else:
+                    await write_message(writer, {"error": f"Unknown op {op}"})
+        except (OSError, asyncio.IncompleteReadError, ValueError, KeyError):
+            logger.exception("Dropping client")
+        finally:
+            writer.close()
+
+    def _put(self, digest, data):
+        if not _is_digest(digest):
+            raise ValueError("Invalid hash")
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError("Blob doesn't match its hash")
+        path = self.blobs / digest
+        temporary = path.with_name(f"{digest}.{os.getpid()}.{id(data)}")
+        temporary.write_bytes(data)
+        temporary.replace(path)
+        self._add_size(len(data))
+
+    def _touch(self, digest) -> bool:
+        """Mark the blob as used, for pruning, and return whether we have it."""
+        try:
+            os.utime(self.blobs / digest)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _stored(self):
+        for path in self.blobs.iterdir():
+            # Skip uploads that are still being written.
+            if "." in path.name:
+                continue
+            try:
+                info = path.stat()
+            except FileNotFoundError:
+                continue
+            yield info.st_mtime_ns, info.st_size, path
+
+    def _add_size(self, size):
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._stored())
+        else:
+            self._size += size
+        if self._size > self.max_size:
+            self.prune()
+
+    def prune(self, target_size: int = None):
+        """Delete least recently used blobs until the store is under target_size."""
+        if target_size is None:
+            target_size = self.max_size * 9 // 10
+        blobs = sorted(self._stored())
+        total = sum(size for _, size, _ in blobs)
+        for _, size, path in blobs:
+            if total <= target_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+        self._size = total
+
+    async def _run(self, request):
+        _check_argv(request["argv"], self.compilers)
+        if not all(_is_digest(digest) for digest in request["inputs"].values()):
+            raise ValueError("Invalid hash")
+        sandbox = pathlib.Path(tempfile.mkdtemp(dir=self.sandboxes))
+        try:
+            for relative, digest in request["inputs"].items():
+                path = _sandbox_path(sandbox, relative)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                os.link(self.blobs / digest, path)
+                self._touch(digest)
+            result = await process.run(request["argv"], sandbox)
+            files = []
+            found = []
+            for relative in request["outputs"]:
+                path = _sandbox_path(sandbox, relative)
+                if path.exists():
+                    files.append(path.read_bytes())
+                    found.append(relative)
+            reply = {"returncode": result.returncode, "output": list(result.output), "outputs": found}
+            if result.rusage is not None:
+                reply["rusage"] = {"user_time": result.rusage.ru_utime, "system_time": result.rusage.ru_stime}
+                if result.max_memory is not None:
+                    reply["rusage"]["max_rss_kb"] = result.max_memory // 1024
+            return reply, files
+        finally:
+            shutil.rmtree(sandbox, ignore_errors=True)
+
+class WorkerClient:
+    def __init__(self, address, index, token=None):
+        self.address = address
+        self.index = index
+        self.token = token
+        self.jobs = None
+        self.failed = False
+        self.slots = []
+        self.known = set()
+        self._idle = []
+
+    async def connect(self):
+        if self._idle:
+            return self._idle.pop()
+        reader, writer = await _open(self.address)
+        # Every connection is authorized on its own.
+        await write_message(writer, {"op": "hello", "token": self.token})
+        header, _ = await read_message(reader)
+        if header is None or "error" in header:
+            writer.close()
+            raise ValueError(header["error"] if header else "Connection closed")
+        if self.jobs is None:
+            self.jobs = header["jobs"]
+            self.slots = list(reversed(range(self.jobs)))
+        return reader, writer
+
+    def done(self, connection):
+        self._idle.append(connection)
+
+class Executor:
+    """Sends commands to the least loaded worker that has a free slot."""
+    def __init__(self, addresses: list[str], token=None):
+        self.workers = [WorkerClient(address, i, token) for i, address in enumerate(addresses)]
+        self._hello_task = None
+
+    async def _hello(self):
+        for worker in self.workers:
+            try:
+                worker.done(await worker.connect())
+            except (OSError, asyncio.IncompleteReadError, ValueError, KeyError):
+                logger.warning(f"Remote worker {worker.address} is unavailable")
+                worker.failed = True
+
+    async def reserve(self):
+        """Return (worker, slot) or None when every worker is busy."""
+        if self._hello_task is None:
+            self._hello_task = asyncio.ensure_future(self._hello())
+        await self._hello_task
+        available = [w for w in self.workers if not w.failed and w.slots]
+        if not available:
+            return None
+        worker = max(available, key=lambda w: len(w.slots) / w.jobs)
+        return worker, worker.slots.pop()
+
+    def release(self, reservation):
+        worker, slot = reservation
+        worker.slots.append(slot)
+
+    def track(self, reservation) -> int:
+        worker, slot = reservation
+        return TRACK_BASE * (worker.index + 1) + slot
+
+    async def run(self, reservation, argv: list[str], inputs: dict[str, pathlib.Path], outputs: dict[str, pathlib.Path]) -> dict:
+        """Run argv in a sandbox holding inputs and copy the requested outputs back.
+
+        Returns the worker's reply with returncode, output lines and rusage.
+        """
+        worker, _ = reservation
+        try:
+            connection = await worker.connect()
+            reader, writer = connection
+            hashes = {relative: await asyncio.to_thread(cache.hash_file, path) for relative, path in inputs.items()}
+            unknown = sorted(set(hashes.values()) - worker.known)
+            if unknown:
+                await write_message(writer, {"op": "missing", "hashes": unknown})
+                header, _ = await read_message(reader)
+                paths = {hashes[relative]: path for relative, path in inputs.items()}
+                for digest in header["hashes"]:
+                    data = await asyncio.to_thread(paths[digest].read_bytes)
+                    await write_message(writer, {"op": "put", "hash": digest}, [data])
+                    await read_message(reader)
+                worker.known.update(unknown)
+            await write_message(writer, {"op": "run", "argv": argv, "inputs": hashes, "outputs": list(outputs)})
+            reply, files = await read_message(reader)
+            if reply is None:
+                raise ConnectionError("Connection closed")
+        except (OSError, asyncio.IncompleteReadError, ValueError, KeyError) as e:
+            worker.failed = True
+            raise RemoteError(f"{worker.address}: {e}") from e
+        worker.done(connection)
+        if "error" in reply:
+            # The worker may have lost blobs we think it has.
+            worker.known.clear()
+            raise RemoteError(f"{worker.address}: {reply['error']}")
+        for relative, data in zip(reply["outputs"], files):
+            await asyncio.to_thread(outputs[relative].write_bytes, data)
+        reply["output"] = collections.deque(tuple(line) for line in reply["output"])
+        return reply
+
+def configure(addresses: list[str]):
+    """Send remotable steps to the workers at addresses. A path is a Unix socket, host:port is TCP."""
+    global executor
+    executor = Executor(addresses, os.environ.get(TOKEN_VARIABLE)) if addresses else None
+
+async def serve(address, directory, jobs, compilers=DEFAULT_COMPILERS, token=None, max_size=5 * cache.GB):
+    worker = Worker(directory, jobs, compilers, token, max_size)
+    if ":" in address and not address.startswith("/"):
+        if not token:
+            raise ValueError(f"Set {TOKEN_VARIABLE} to serve over TCP")
+        host, _, port = address.rpartition(":")
+        server = await asyncio.start_server(worker.handle, host, int(port))
+    else:
+        path = address.removeprefix("unix:")
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(worker.handle, path)
+        os.chmod(path, 0o600)
+    logger.info(f"Serving on {address} with {jobs} jobs")
+    async with server:
+        await server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build worker")
+    parser.add_argument("--listen", required=True, help="Unix socket path or host:port")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--directory", type=pathlib.Path, default=cache.default_directory() / "worker")
+    parser.add_argument("--compiler", action="append", dest="compilers",
+            help=f"Compiler that clients may run, as they name it (repeatable, default {' and '.join(DEFAULT_COMPILERS)})")
+    parser.add_argument("--max-size", type=float, default=5, help="Gigabytes of inputs to keep between commands")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(args.listen, args.directory, args.jobs, args.compilers or DEFAULT_COMPILERS, os.environ.get(TOKEN_VARIABLE) or None,
+                      int(args.max_size * cache.GB)))
+
+if __name__ == "__main__":
+    main()
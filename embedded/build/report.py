@@ -0,0 +1,203 @@
+"""Summarize a build trace: critical path, slowest steps, parallelism and regressions."""
+
+import argparse
+import bisect
+import collections
+import json
+import sys
+
+def load(path) -> list[dict]:
+    """Load trace events, tolerating a trace whose array was never closed."""
+    with open(path) as f:
+        text = f.read().strip()
+    if not text.endswith("]"):
+        text = text.rstrip(",") + "]"
+    events = json.loads(text)
+    if isinstance(events, dict):
+        events = events.get("traceEvents", [])
+    return events
+
+class Build:
+    def __init__(self, events: list[dict]):
+        self.jobs = None
+        for e in events:
+            if e.get("ph") == "M" and e.get("name") == "process_name" and e.get("pid") == 0:
+                self.jobs = e.get("args", {}).get("jobs")
+        # Steps are the top level events. Others, such as compiler time traces, have a category.
+        self.steps = [e for e in events if e.get("ph") == "X" and "cat" not in e]
+        self.steps.sort(key=lambda e: e["ts"])
+        self.compiler_events = [e for e in events if e.get("ph") == "X" and e.get("cat") == "clang"]
+        if self.steps:
+            self.start = self.steps[0]["ts"]
+            self.end = max(e["ts"] + e["dur"] for e in self.steps)
+        else:
+            self.start = self.end = 0
+
+        self._by_track = collections.defaultdict(list)
+        for step in self.steps:
+            self._by_track[step["tid"]].append(step)
+        self._track_starts = {tid: [s["ts"] for s in steps] for tid, steps in self._by_track.items()}
+
+        flows = {}
+        for e in events:
+            if e.get("ph") in ("s", "f") and e.get("cat") == "dependency":
+                flows.setdefault(e["id"], {})[e["ph"]] = e
+        self.dependencies = collections.defaultdict(list)
+        for flow in flows.values():
+            if "s" not in flow or "f" not in flow:
+                continue
+            producer = self._step_at(flow["s"]["tid"], flow["s"]["ts"])
+            consumer = self._step_at(flow["f"]["tid"], flow["f"]["ts"])
+            if producer is not None and consumer is not None:
+                self.dependencies[id(consumer)].append(producer)
+
+    def _step_at(self, tid, ts):
+        steps = self._by_track.get(tid)
+        if not steps:
+            return None
+        i = bisect.bisect_right(self._track_starts[tid], ts) - 1
+        if i >= 0 and steps[i]["ts"] <= ts <= steps[i]["ts"] + steps[i]["dur"]:
+            return steps[i]
+        return None
+
+    @property
+    def wall_time(self):
+        return self.end - self.start
+
+    def critical_path(self) -> list[dict]:
+        """Walk back from the last step to finish through whatever it waited on.
+
+        Recorded dependencies are followed when there are any. Otherwise the step that finished
+        last before this one started is assumed to be what it waited for.
+        """
+        if not self.steps:
+            return []
+        ends = sorted((s["ts"] + s["dur"], i) for i, s in enumerate(self.steps))
+        end_times = [end for end, _ in ends]
+        current = max(self.steps, key=lambda s: s["ts"] + s["dur"])
+        path = [current]
+        while True:
+            producers = self.dependencies.get(id(current))
+            if producers:
+                previous = max(producers, key=lambda s: s["ts"] + s["dur"])
+            else:
+                i = bisect.bisect_right(end_times, current["ts"]) - 1
+                if i < 0:
+                    break
+                previous = self.steps[ends[i][1]]
+            path.append(previous)
+            current = previous
+        path.reverse()
+        return path
+
+    def slowest(self, count) -> list[dict]:
+        return sorted(self.steps, key=lambda s: s["dur"], reverse=True)[:count]
+
+    def busy_time(self):
+        return sum(s["dur"] for s in self.steps)
+
+    def utilization(self, jobs=None):
+        jobs = jobs or self.jobs or len(self._by_track)
+        if not self.wall_time or not jobs:
+            return 0.0
+        return self.busy_time() / (self.wall_time * jobs)
+
+    def idle_time(self) -> dict:
+        return {tid: self.wall_time - sum(s["dur"] for s in steps) for tid, steps in sorted(self._by_track.items())}
+
+    def header_costs(self) -> dict:
+        """Total time clang spent parsing each source and header, from merged -ftime-trace data."""
+        result = collections.defaultdict(int)
+        for e in self.compiler_events:
+            if e["name"] == "Source":
+                result[e.get("args", {}).get("detail", "?")] += e["dur"]
+        return result
+
+    def durations(self) -> dict:
+        result = collections.defaultdict(int)
+        for step in self.steps:
+            result[step["name"]] += step["dur"]
+        return result
+
+def compare(current: Build, baseline: Build, threshold=0.1, minimum=100_000) -> dict:
+    """Find steps, and the build overall, that got slower by more than threshold and minimum microseconds."""
+    def regressed(now, before):
+        return now - before > minimum and now > before * (1 + threshold)
+    steps = []
+    before = baseline.durations()
+    for name, duration in current.durations().items():
+        if name in before and regressed(duration, before[name]):
+            steps.append({"name": name, "baseline": before[name], "current": duration})
+    steps.sort(key=lambda s: s["current"] - s["baseline"], reverse=True)
+    return {"wall_time": {"baseline": baseline.wall_time, "current": current.wall_time,
+                          "regressed": regressed(current.wall_time, baseline.wall_time)},
+            "steps": steps}
+
+def _seconds(microseconds):
+    return f"{microseconds / 1_000_000:.3f}s"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("trace", help="Trace written by the build")
+    parser.add_argument("--baseline", help="Earlier trace to compare against")
+    parser.add_argument("-n", "--top", type=int, default=10, help="Number of slowest steps to list")
+    parser.add_argument("-j", "--jobs", type=int, help="Job count to measure utilization against (default: from the trace)")
+    parser.add_argument("--headers", type=int, default=0, help="Number of most expensive headers to list, from -ftime-trace data")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Fractional slowdown that counts as a regression")
+    parser.add_argument("--minimum", type=float, default=0.1, help="Seconds of slowdown that counts as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with 1 if the build got slower than the baseline")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    build = Build(load(args.trace))
+    jobs = args.jobs or build.jobs
+    report = {
+        "wall_time": build.wall_time,
+        "busy_time": build.busy_time(),
+        "jobs": jobs,
+        "utilization": build.utilization(jobs),
+        "critical_path": [{"name": s["name"], "duration": s["dur"]} for s in build.critical_path()],
+        "slowest": [{"name": s["name"], "duration": s["dur"]} for s in build.slowest(args.top)],
+        "idle_time": build.idle_time(),
+    }
+    if args.headers:
+        costs = sorted(build.header_costs().items(), key=lambda h: h[1], reverse=True)[:args.headers]
+        report["headers"] = [{"name": name, "duration": duration} for name, duration in costs]
+    if args.baseline:
+        report["comparison"] = compare(build, Build(load(args.baseline)), args.threshold, int(args.minimum * 1_000_000))
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print(f"Wall time {_seconds(report['wall_time'])}, busy {_seconds(report['busy_time'])}, "
+              f"{report['utilization']:.0%} utilization of {jobs} jobs")
+        critical_time = sum(s["duration"] for s in report["critical_path"])
+        print(f"\nCritical path ({_seconds(critical_time)}):")
+        for step in report["critical_path"]:
+            print(f"  {_seconds(step['duration']):>10} {step['name']}")
+        print(f"\nSlowest {args.top} steps:")
+        for step in report["slowest"]:
+            print(f"  {_seconds(step['duration']):>10} {step['name']}")
+        print("\nIdle time per track:")
+        for tid, idle in report["idle_time"].items():
+            print(f"  {tid:>4} {_seconds(idle)}")
+        if "headers" in report:
+            print(f"\nMost expensive {args.headers} headers:")
+            for header in report["headers"]:
+                print(f"  {_seconds(header['duration']):>10} {header['name']}")
+        if "comparison" in report:
+            comparison = report["comparison"]
+            wall = comparison["wall_time"]
+            print(f"\nWall time {_seconds(wall['baseline'])} -> {_seconds(wall['current'])}" + (" REGRESSED" if wall["regressed"] else ""))
+            for step in comparison["steps"]:
+                print(f"  {_seconds(step['baseline']):>10} -> {_seconds(step['current']):>10} {step['name']}")
+
+    if args.fail_on_regression and "comparison" in report:
+        comparison = report["comparison"]
+        if comparison["wall_time"]["regressed"]:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""Firmware size from lld link maps and --print-memory-usage output, and comparisons between builds."""
+
+import argparse
+import collections
+import json
+import re
+import sys
+
+UNITS = {"B": 1, "KB": 1024, "MB": 1024 * 1024, "GB": 1024 * 1024 * 1024}
+
+_MEMORY_USAGE = re.compile(r"^\s*(\S+):\s+(\d+)\s*([KMG]?B)\s+(\d+)\s*([KMG]?B)\s+[\d.]+%")
+# VMA, LMA, size, alignment and then the output section, input section or symbol, indented by level.
+_MAP_LINE = re.compile(r"^\s*([0-9a-fA-F]+)\s+([0-9a-fA-F]+)\s+([0-9a-fA-F]+)\s+(\d+) (\s*)(\S.*)$")
+_INPUT_SECTION = re.compile(r"^(.*):\((\S+)\)$")
+
+# Sections that aren't loaded onto the device.
+UNLOADED = (".debug", ".comment", ".symtab", ".strtab", ".shstrtab", ".ARM.attributes", ".riscv.attributes")
+
+def parse_memory_usage(lines) -> dict:
+    """Used and total bytes of each memory region from the linker's --print-memory-usage output."""
+    regions = {}
+    for line in lines:
+        match = _MEMORY_USAGE.match(line)
+        if match:
+            name, used, used_unit, size, size_unit = match.groups()
+            regions[name] = {"used": int(used) * UNITS[used_unit], "size": int(size) * UNITS[size_unit]}
+    return regions
+
+def parse_map(path) -> dict:
+    """Bytes used by each loaded output section, object file and symbol according to an lld map.
+
+    Object files are named as the map names them, for example libc.a(memcpy.o). Symbols are
+    sized by the distance to the next symbol in their input section.
+    """
+    sections = {}
+    objects = collections.Counter()
+    symbols = {}
+    section = None
+    input_end = None
+    previous = None
+
+    def finish_symbol(end):
+        nonlocal previous
+        if previous is not None:
+            name, address = previous
+            symbols[name] = symbols.get(name, 0) + max(end - address, 0)
+        previous = None
+
+    with open(path) as f:
+        for line in f:
+            match = _MAP_LINE.match(line)
+            if match is None:
+                continue
+            address, _, size, _, indent, name = match.groups()
+            address = int(address, 16)
+            size = int(size, 16)
+            level = len(indent) // 8
+            if level == 0:
+                finish_symbol(input_end)
+                section = None if name.startswith(UNLOADED) else name
+                if section is not None:
+                    sections[section] = sections.get(section, 0) + size
+            elif section is None:
+                continue
+            elif level == 1:
+                finish_symbol(input_end)
+                input_end = address + size
+                input_section = _INPUT_SECTION.match(name)
+                if input_section is not None and size:
+                    objects[input_section.group(1)] += size
+            else:
+                finish_symbol(address)
+                previous = (name, address)
+        finish_symbol(input_end)
+    return {"sections": sections, "objects": dict(objects), "symbols": {name: size for name, size in symbols.items() if size}}
+
+def analyze(map_file=None, link_output=()) -> dict:
+    result = {"regions": parse_memory_usage(link_output)}
+    if map_file is not None:
+        result.update(parse_map(map_file))
+    return result
+
+def compare(current: dict, baseline: dict) -> dict:
+    """Change in bytes of everything that differs between two analyses, largest growth first."""
+    result = {}
+    for kind in ("regions", "sections", "objects", "symbols"):
+        now = current.get(kind, {})
+        before = baseline.get(kind, {})
+        changes = []
+        for name in now.keys() | before.keys():
+            size = now.get(name, 0)
+            previous = before.get(name, 0)
+            if kind == "regions":
+                size = size["used"] if size else 0
+                previous = previous["used"] if previous else 0
+            if size != previous:
+                changes.append({"name": name, "baseline": previous, "current": size, "change": size - previous})
+        changes.sort(key=lambda c: c["change"], reverse=True)
+        result[kind] = changes
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("size", help="Size file written next to a linked ELF (.elf.size.json)")
+    parser.add_argument("--baseline", help="Size file of an earlier build to compare against")
+    parser.add_argument("-n", "--top", type=int, default=10, help="Number of largest objects and symbols, or changes, to list")
+    parser.add_argument("--fail-on-growth", action="store_true", help="Exit with 1 if any memory region grew compared to the baseline")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    with open(args.size) as f:
+        current = json.load(f)
+    comparison = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            comparison = compare(current, json.load(f))
+
+    if args.json:
+        json.dump(comparison if comparison is not None else current, sys.stdout, indent=2)
+        print()
+    elif comparison is not None:
+        for kind, changes in comparison.items():
+            if not changes:
+                continue
+            print(f"{kind.capitalize()}:")
+            for change in changes[:args.top]:
+                print(f"  {change['change']:+10} {change['baseline']:>10} -> {change['current']:<10} {change['name']}")
+    else:
+        print("Regions:")
+        for name, region in current.get("regions", {}).items():
+            print(f"  {name:>12} {region['used']:>10} of {region['size']:<10} {region['used'] / region['size']:.1%}" if region["size"] else f"  {name:>12} {region['used']:>10}")
+        for kind in ("sections", "objects", "symbols"):
+            sizes = sorted(current.get(kind, {}).items(), key=lambda s: s[1], reverse=True)[:args.top]
+            print(f"\nLargest {kind}:")
+            for name, size in sizes:
+                print(f"  {size:>10} {name}")
+
+    if args.fail_on_growth and comparison is not None:
+        if any(change["change"] > 0 for change in comparison["regions"]):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
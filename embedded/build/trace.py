@@ -0,0 +1,125 @@
+import itertools
+import json
+import os
+import time
+
+# How often system load and memory are sampled, in microseconds.
+SAMPLE_INTERVAL = 100_000
+# How often buffered events are flushed to disk, in microseconds.
+FLUSH_INTERVAL = 500_000
+
+def now() -> int:
+    """Current trace timestamp in microseconds."""
+    return time.perf_counter_ns() // 1000
+
+# Difference between wall clock and trace timestamps, in microseconds.
+_epoch_offset = time.time_ns() // 1000 - now()
+
+def from_epoch(microseconds: int) -> int:
+    """Convert microseconds since the Unix epoch to a trace timestamp."""
+    return microseconds - _epoch_offset
+
+def available_memory():
+    """Available system memory in bytes or None if unknown."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def load_time_trace(path, track, start, end) -> list[dict]:
+    """Convert clang's -ftime-trace output into events on track between start and end."""
+    with open(path) as f:
+        data = json.load(f)
+    beginning = data.get("beginningOfTime")
+    events = []
+    for e in data.get("traceEvents", ()):
+        # Total events summarize the whole run and aren't placed in time.
+        if e.get("ph") != "X" or e["name"].startswith("Total "):
+            continue
+        if beginning is not None:
+            ts = from_epoch(beginning + e["ts"])
+        else:
+            ts = start + e["ts"]
+        ts = min(max(ts, start), end)
+        dur = min(e.get("dur", 0), end - ts)
+        event = {"name": e["name"], "cat": "clang", "ph": "X", "pid": 0, "tid": track, "ts": ts, "dur": dur}
+        if "args" in e:
+            event["args"] = e["args"]
+        events.append(event)
+    return events
+
+class Trace:
+    """Chrome trace written to disk as events happen.
+
+    Events are written as a JSON array whose closing bracket is added by close(). Trace viewers
+    accept the array without it so a trace from a crashed build is still readable. Steps are
+    linked to the steps that consume their outputs with flow events.
+    """
+    def __init__(self, path, job_count=None):
+        self.path = path
+        self._file = open(path, "w")
+        self._file.write("[\n")
+        self._first = True
+        self._last_flush = now()
+        self._last_sample = 0
+        self._flow_ids = itertools.count(1)
+        # Output path -> (pid, track, end timestamp) of the step that wrote it.
+        self._producers = {}
+        self.event({"name": "process_name", "ph": "M", "pid": 0, "args": {"name": "embedded build", "jobs": job_count}})
+        if job_count is not None:
+            for track in range(job_count):
+                self.event({"name": "thread_name", "ph": "M", "pid": 0, "tid": track, "args": {"name": f"job {track}"}})
+
+    def event(self, event: dict):
+        if self._file is None:
+            return
+        if not self._first:
+            self._file.write(",\n")
+        self._first = False
+        self._file.write(json.dumps(event))
+        timestamp = now()
+        if timestamp - self._last_flush > FLUSH_INTERVAL:
+            self._file.flush()
+            self._last_flush = timestamp
+
+    def complete(self, name, track, start, end, args=None, inputs=(), outputs=(), pid=0):
+        """Record a finished step and link it to the steps that produced its inputs."""
+        event = {"name": name, "ph": "X", "pid": pid, "tid": track, "ts": start, "dur": end - start}
+        if args:
+            event["args"] = args
+        self.event(event)
+        for path in inputs:
+            producer = self._producers.get(os.path.abspath(path))
+            if producer is None:
+                continue
+            flow_id = next(self._flow_ids)
+            producer_pid, producer_track, producer_end = producer
+            self.event({"name": "dependency", "cat": "dependency", "ph": "s", "id": flow_id, "pid": producer_pid, "tid": producer_track, "ts": producer_end - 1})
+            self.event({"name": "dependency", "cat": "dependency", "ph": "f", "bp": "e", "id": flow_id, "pid": pid, "tid": track, "ts": start})
+        for path in outputs:
+            self._producers[os.path.abspath(path)] = (pid, track, end)
+
+    def counters(self, timestamp, name, values: dict):
+        self.event({"name": name, "ph": "C", "pid": 0, "ts": timestamp, "args": values})
+
+    def sample_system(self, timestamp):
+        """Record load average and available memory if they haven't been sampled recently."""
+        if timestamp - self._last_sample < SAMPLE_INTERVAL:
+            return
+        self._last_sample = timestamp
+        if hasattr(os, "getloadavg"):
+            self.counters(timestamp, "load average", {"1 minute": os.getloadavg()[0]})
+        memory = available_memory()
+        if memory is not None:
+            self.counters(timestamp, "available memory", {"MB": memory // (1024 * 1024)})
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.write("\n]\n")
+        self._file.close()
+        self._file = None
@@ -0,0 +1,191 @@
+"""Notice changes to files with inotify, or by polling where inotify isn't available."""
+
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# Watch descriptor, mask, cookie and name length of struct inotify_event.
+_EVENT = struct.Struct("iIII")
+
+# Seconds between scans of a PollingWatcher.
+POLL_INTERVAL = 0.5
+
+class Watcher:
+    """Common part of watchers.
+
+    changes() collects what changed, without waiting, and passes it to each of listeners. Only
+    one caller sees the result, so others listen or use accumulated().
+    """
+    def __init__(self):
+        self._accumulated = set()
+        self.listeners = []
+
+    def _report(self, changed):
+        if changed is None or self._accumulated is None:
+            self._accumulated = None
+        else:
+            self._accumulated.update(changed)
+        for listener in self.listeners:
+            listener(changed)
+        return changed
+
+    def accumulated(self):
+        """Every path reported by changes() since the last call, or None if changes were lost."""
+        self.changes()
+        result = self._accumulated
+        self._accumulated = set()
+        return result
+
+class InotifyWatcher(Watcher):
+    """Watches the directories of files with inotify.
+
+    Events are queued by the kernel as files change, so changes() is exact: a file in a watched
+    directory that isn't reported hasn't changed since it was watched.
+    """
+    reliable = True
+
+    def __init__(self):
+        super().__init__()
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        # Watch descriptor -> directory and back.
+        self._directories = {}
+        self._watches = {}
+
+    def watch(self, paths):
+        """Watch the directories of paths that aren't watched yet."""
+        for path in paths:
+            directory = os.path.dirname(os.path.abspath(path))
+            if directory in self._watches:
+                continue
+            descriptor = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+            if descriptor < 0:
+                logger.debug(f"Can't watch {directory}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self._directories[descriptor] = directory
+            self._watches[directory] = descriptor
+
+    def covers(self, path) -> bool:
+        return os.path.dirname(path) in self._watches
+
+    def changes(self):
+        """Paths changed since the last call, without waiting, or None if changes were lost."""
+        changed = set()
+        lost = False
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                descriptor, mask, _, length = _EVENT.unpack_from(data, offset)
+                name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b"\0")
+                offset += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    lost = True
+                    continue
+                directory = self._directories.get(descriptor)
+                if directory is None:
+                    continue
+                if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                    # Everything in the directory may be gone. It's watched again if it comes back.
+                    lost = True
+                    del self._directories[descriptor]
+                    self._watches.pop(directory, None)
+                    continue
+                changed.add(os.path.join(directory, os.fsdecode(name)))
+        return self._report(None if lost else changed)
+
+    async def wait(self):
+        """Wait until there are changes to collect with changes()."""
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_reader(self._fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            loop.remove_reader(self._fd)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+class PollingWatcher(Watcher):
+    """Watches files by comparing their modification times every POLL_INTERVAL seconds.
+
+    Changes are only noticed on a scan so it can't vouch for files between scans.
+    """
+    reliable = False
+
+    def __init__(self):
+        super().__init__()
+        self._mtimes = {}
+        self._pending = set()
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def watch(self, paths):
+        for path in paths:
+            path = os.path.abspath(path)
+            if path not in self._mtimes:
+                self._mtimes[path] = self._mtime(path)
+
+    def covers(self, path) -> bool:
+        return False
+
+    def _scan(self):
+        for path, mtime in self._mtimes.items():
+            current = self._mtime(path)
+            if current != mtime:
+                self._mtimes[path] = current
+                self._pending.add(path)
+
+    def changes(self):
+        self._scan()
+        changed = self._pending
+        self._pending = set()
+        return self._report(changed)
+
+    async def wait(self):
+        while not self._pending:
+            await asyncio.sleep(POLL_INTERVAL)
+            await asyncio.to_thread(self._scan)
+
+    def close(self):
+        pass
+
+def watcher():
+    """An InotifyWatcher where the system has inotify, otherwise a PollingWatcher."""
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError):
+        logger.debug("inotify isn't available, polling for changes")
+        return PollingWatcher()
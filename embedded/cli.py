@@ -1,6 +1,5 @@
 import argparse
 import asyncio
-import colorlog
 import inspect
 import logging
 import os
@@ -11,10 +10,38 @@ import warnings
 import embedded
 from embedded import build
 from embedded import cpu
-from embedded import microcontroller
 
 logger = logging.getLogger(__name__)
 
+def _script_files(root):
+    """The build script and the modules it imported from next to it."""
+    inputs = {pathlib.Path(sys.argv[0]).resolve()}
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if path and pathlib.Path(path).resolve().is_relative_to(root):
+            inputs.add(pathlib.Path(path).resolve())
+    return sorted(inputs)
+
+async def record_ninja(coro, run_ninja):
+    """Record the commands of coro into a ninja file and then, if run_ninja, build with ninja.
+
+    Python steps, such as header generation, run now. The ninja file regenerates itself by
+    running the build script again when the script changes.
+    """
+    from embedded.build import ninja
+    root = pathlib.Path(sys.argv[0]).resolve().parent
+    recorder = ninja.Recorder(build.state_directory / "build.ninja", root)
+    build.recorder = recorder
+    try:
+        await coro
+    finally:
+        build.recorder = None
+    arguments = [a for a in sys.argv[1:] if a not in ("--ninja", "--ninja-regenerate")]
+    script = pathlib.Path(sys.argv[0]).resolve()
+    recorder.write([sys.executable, str(script), *arguments, "--ninja-regenerate"], os.getcwd(), _script_files(root))
+    if run_ninja:
+        await ninja.run(root, build_file=recorder.path)
+
 async def run_eager(coro):
     """Run the coroutine with an eager task factory so that functions can capture the parent task."""
     loop = asyncio.get_event_loop()
@@ -25,6 +52,17 @@ def run(function):
     function_args = []
     parser = argparse.ArgumentParser()
     parser.add_argument("-j", "--jobs", type=int, help="Number of concurrent jobs to run")
+    parser.add_argument("-l", "--load-average", type=float,
+            help="Don't start new jobs while the load average is above this (0 for no limit)")
+    parser.add_argument("--memory-limit", type=float,
+            help="Gigabytes of memory that jobs may use together (0 for no limit), by default 90%% of what's available")
+    parser.add_argument("--remote-worker", action="append", dest="remote_workers", default=[],
+            help="Compile on the worker at this Unix socket path or host:port (repeatable)")
+    parser.add_argument("--ninja", action="store_true",
+            help="Write the build's commands to a ninja file and build with ninja")
+    parser.add_argument("--ninja-regenerate", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--watch", action="store_true",
+            help="Keep the build in memory, build again when its sources change and serve later runs of the script")
     parser.add_argument(
         '-d', '--debug',
         help="Print lots of debugging statements",
@@ -62,39 +100,64 @@ def run(function):
 
     cli_args = parser.parse_args()
 
-    if not cli_args.jobs:
-        cli_args.jobs = os.cpu_count()
-    build.init(cli_args.jobs)
-
+    import colorlog
     handler = colorlog.StreamHandler()
     handler.setFormatter(colorlog.ColoredFormatter(
         '%(log_color)s%(levelname)s:%(name)s:%(message)s'))
 
     logging.basicConfig(level=cli_args.loglevel, handlers=[handler])
 
+    from embedded.build import daemon
+    # The daemon only serves runs of the same script with the same arguments.
+    daemon_arguments = [str(pathlib.Path(sys.argv[0]).resolve()), *(a for a in sys.argv[1:] if a != "--watch")]
+    if not cli_args.watch and not cli_args.ninja and not cli_args.ninja_regenerate:
+        returncode = asyncio.run(daemon.request(daemon_arguments))
+        if returncode is not None:
+            sys.exit(returncode)
+
+    if not cli_args.jobs:
+        cli_args.jobs = os.cpu_count()
+    memory_limit = None
+    if cli_args.memory_limit is not None:
+        memory_limit = int(cli_args.memory_limit * 1024 * 1024 * 1024)
+    build.init(cli_args.jobs, memory_limit=memory_limit, load_limit=cli_args.load_average)
+    build.remote.configure(cli_args.remote_workers)
+
     for i, farg in enumerate(function_args):
         if farg == "cpu":
             if cli_args.cpu:
                 function_args[i] = cpu.get_cpu_from_name(cli_args.cpu)
             elif cli_args.mcu:
-                cpu = microcontroller.get_cpu_from_mcu(cli_args.mcu)
-                function_args[i] = cpu
-        elif farg == "cpu":
+                from embedded import microcontroller
+                function_args[i] = microcontroller.get_cpu_from_mcu(cli_args.mcu)
+        elif farg == "mcu":
             if cli_args.mcu:
+                from embedded import microcontroller
                 mcus = microcontroller.get_mcus_from_string(cli_args.mcu)
                 if len(mcus) > 1:
                     for mcu in mcus:
                         logger.warning(mcu)
                     raise ValueError("Multiple MCUs found")
-                function_args[i] = cpu
+                if not mcus:
+                    raise ValueError(f"No MCU matches {cli_args.mcu}")
+                function_args[i] = mcus[0]
+            else:
+                function_args[i] = None
         else:
             function_args[i] = getattr(cli_args, farg)
             if isinstance(function_args[i], pathlib.Path):
                 function_args[i] = function_args[i].resolve()
 
     warnings.simplefilter("ignore")
+    if cli_args.watch:
+        root = pathlib.Path(sys.argv[0]).resolve().parent
+        asyncio.run(run_eager(daemon.serve(lambda: function(*function_args), daemon_arguments, _script_files(root))))
+        return
     #try:
-    asyncio.run(run_eager(function(*function_args)))
+    coro = function(*function_args)
+    if cli_args.ninja or cli_args.ninja_regenerate:
+        coro = record_ninja(coro, run_ninja=not cli_args.ninja_regenerate)
+    asyncio.run(run_eager(coro))
     #except Exception as e:
         # Swallow any exception
         #sys.exit(1)
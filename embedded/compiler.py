@@ -1,12 +1,46 @@
 import inspect
+import json
+import logging
+import os
 import pathlib
+import shlex
 import asyncio
 
 from . import Compiler
 from embedded import build
+import embedded.build.cache
+import embedded.build.size
+from embedded.build import depfile
+
+logger = logging.getLogger(__name__)
 
 cwd = pathlib.Path.cwd()
 
+# Preprocessor options that take the next argument, or one attached to short ones such as -DX=1.
+PREPROCESSOR_OPTIONS = ("-I", "-D", "-U", "-include", "-imacros", "-isystem", "-iquote", "-idirafter", "-iprefix",
+                        "-iwithprefix", "-iwithprefixbefore", "-isysroot", "-include-pch", "-MF", "-MT", "-MQ")
+# Preprocessor options on their own.
+PREPROCESSOR_FLAGS = ("-M", "-MM", "-MD", "-MMD", "-MG", "-MP", "-nostdinc", "-nostdinc++", "-undef")
+
+# Sources that can be #included into a unity file of the same suffix. Others, such as
+# assembly, are compiled on their own.
+UNITY_SUFFIXES = (".c", ".cc", ".cpp", ".cxx")
+
+def compile_only_flags(flags: list[str]) -> list[str]:
+    """flags without the options that were used up by preprocessing, as distcc strips them."""
+    result = []
+    skip = False
+    for flag in flags:
+        if skip:
+            skip = False
+        elif flag in PREPROCESSOR_OPTIONS:
+            skip = True
+        elif flag in PREPROCESSOR_FLAGS or flag.startswith(("-I", "-D", "-U", "-MF", "-MT", "-MQ", "-Wp,")):
+            pass
+        else:
+            result.append(flag)
+    return result
+
 class GCC(Compiler):
     def __init__(self):
         self.c_compiler = "arm-none-eabi-gcc"
@@ -15,16 +49,233 @@ class GCC(Compiler):
         self.strip = "arm-none-eabi-strip"
 
 class Clang(Compiler):
-    def __init__(self):
+    def __init__(self, object_cache: build.cache.ObjectCache = None, incremental: bool = True, time_trace: bool = False, lto: str = None, direct_cc1: bool = False):
         self.c_compiler = "clang"
         self.cpp_compiler = "clang++"
         self.ar = "llvm-ar"
         self.strip = "llvm-strip"
+        self.object_cache = object_cache
+        # Skip steps whose command line, inputs and outputs match the last run.
+        self.incremental = incremental
+        # Compile with -ftime-trace and merge each file's trace into the build trace.
+        self.time_trace = time_trace
+        # Target compile time, in seconds, and maximum size of unity groups in compile_sources().
+        self.unity_time = 4.0
+        self.unity_size = 32
+        # None, "full" or "thin". Objects are compiled to bitcode and optimized together at link.
+        if lto not in (None, "full", "thin"):
+            raise ValueError(f"Unknown LTO mode {lto}")
+        self.lto = lto
+        # ThinLTO keeps optimized modules here between links, pruned to lto_cache_size bytes.
+        self.lto_cache_directory = build.cache.default_directory() / "thinlto"
+        self.lto_cache_size = 1024 * 1024 * 1024
+        # (build, cpu, flags, directory) -> (precompiled header, future that's True once it's built)
+        self._precompiled_headers = {}
+        # Run clang -cc1 directly, skipping the driver, with the arguments the driver chose for
+        # the first file compiled with the same command line.
+        self.direct_cc1 = direct_cc1
+        # (build, directory, suffix, command) -> future of (cc1 arguments, [(index, role)]) or None
+        self._cc1_templates = {}
+
+    async def _merge_time_trace(self, output_file, result):
+        if build.trace_sink is None or result.track is None:
+            return
+        # Clang names the trace after the object file.
+        time_trace = output_file.with_suffix(".json")
+        try:
+            events = await asyncio.to_thread(build.trace.load_time_trace, time_trace, result.track, result.start_time, result.end_time)
+        except (OSError, ValueError):
+            logger.debug(f"No time trace for {output_file}")
+            return
+        for event in events:
+            build.trace_sink.event(event)
+
+    def _up_to_date(self, outputs, command, description):
+        # Ninja decides what's up to date when the build is being recorded.
+        if not self.incremental or build.state is None or build.recorder is not None:
+            return False
+        if build.state.up_to_date(outputs, command):
+            logger.debug(f"{description} (up to date)")
+            return True
+        return False
+
+    async def _record(self, outputs, command, inputs=None, working_directory=None, extra_inputs=()):
+        """Record a finished step. Inputs default to those in the step's dependency file."""
+        if not self.incremental or build.state is None or build.recorder is not None:
+            return
+        def record():
+            nonlocal inputs
+            if inputs is None:
+                inputs = depfile.parse(outputs[1], working_directory)
+            build.state.record(outputs, command, [*inputs, *extra_inputs])
+        await asyncio.to_thread(record)
 
     @build.capture_caller_directory
     async def preprocess(self, source_file: pathlib.Path, output_file: pathlib.Path, flags: list[pathlib.Path], caller_directory=None):
         output_file.parent.mkdir(parents=True, exist_ok=True)
-        await build.run_command([self.c_compiler, "-E", "-MMD", "-c", source_file, *flags, "-o", output_file], description=f"Preprocess {source_file.relative_to(cwd)} -> {output_file.relative_to(cwd)}", working_directory=caller_directory)
+        command = [self.c_compiler, "-E", "-MMD", "-c", source_file, *flags, "-o", output_file]
+        description = f"Preprocess {source_file.relative_to(cwd)} -> {output_file.relative_to(cwd)}"
+        outputs = [output_file, output_file.with_suffix(".d")]
+        formatted = build.format_command(command, caller_directory)
+        if self._up_to_date(outputs, formatted, description):
+            return
+        await build.run_command(command, description=description, working_directory=caller_directory, inputs=[source_file], outputs=outputs)
+        await self._record(outputs, formatted, working_directory=caller_directory)
+
+    def _lto_flags(self) -> list[str]:
+        if self.lto == "full":
+            return ["-flto=full"]
+        if self.lto == "thin":
+            return ["-flto=thin"]
+        return []
+
+    def _precompiled_header_key(self, cpu, flags, caller_directory):
+        # A warm daemon builds again in the same process so headers are only shared within a build.
+        return (build.generation, cpu.unique_id, tuple(str(f) for f in flags), caller_directory)
+
+    @build.capture_caller_directory
+    async def precompile_header(self, cpu, header: pathlib.Path, output_file: pathlib.Path, flags: list[pathlib.Path], caller_directory=None):
+        """Precompile header for compiles with the same cpu and flags.
+
+        Compiles with matching flags started after this call wait for the header and include it
+        with -include-pch. The header is only built once per cpu and flags.
+        """
+        if isinstance(output_file, str):
+            output_file = caller_directory / output_file
+        if isinstance(header, str):
+            header = caller_directory / header
+        key = self._precompiled_header_key(cpu, flags, caller_directory)
+        if key in self._precompiled_headers:
+            await self._precompiled_headers[key][1]
+            return
+        built = asyncio.get_running_loop().create_future()
+        self._precompiled_headers[key] = (output_file, built)
+        try:
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            cpu_flags = cpu.get_arch_cflags(self)
+            command = [self.c_compiler, *cpu_flags, "-x", "c-header", "-MMD", "-c", header, *flags, "-o", output_file]
+            description = f"Precompile {header.relative_to(cwd)} -> {output_file.relative_to(cwd)}"
+            outputs = [output_file, output_file.with_suffix(".d")]
+            formatted = build.format_command(command, caller_directory)
+            if not self._up_to_date(outputs, formatted, description):
+                # Every matching compile waits for this.
+                await build.run_command(command, description=description, working_directory=caller_directory, inputs=[header], outputs=outputs, critical=True)
+                await self._record(outputs, formatted, working_directory=caller_directory)
+        except BaseException:
+            # Compiles waiting on the header go ahead without it. The build fails from here.
+            built.set_result(False)
+            raise
+        built.set_result(True)
+
+    async def _precompiled_header(self, cpu, flags, caller_directory):
+        """Return the precompiled header for cpu and flags once it's built, or None if there isn't one."""
+        entry = self._precompiled_headers.get(self._precompiled_header_key(cpu, flags, caller_directory))
+        if entry is None:
+            return None
+        output_file, built = entry
+        return output_file if await built else None
+
+    async def _query_cc1(self, command, values, caller_directory):
+        """Ask the driver which cc1 command it would run for command and note which arguments
+        are the file's. None if it runs something else or passes file specific arguments we
+        can't fill in.
+        """
+        async with build.job_slot():
+            result = await build.process.run([command[0], "-###", *command[1:]], caller_directory)
+        jobs = [shlex.split(line) for line in result.lines("stderr") if line.startswith(' "')]
+        if result.returncode != 0 or len(jobs) != 1 or jobs[0][1:2] != ["-cc1"]:
+            logger.debug(f"Can't run cc1 directly for {shlex.join(command)}")
+            return None
+        argv = jobs[0]
+        by_value = {values["source"]: "source", values["output"]: "output", values["dependency"]: "dependency"}
+        output_stem = os.path.splitext(values["output"])[0]
+        roles = []
+        for index, part in enumerate(argv):
+            if index > 0 and argv[index - 1] == "-main-file-name":
+                roles.append((index, "main_file_name"))
+            elif part in by_value:
+                roles.append((index, by_value[part]))
+            elif values["source"] in part or output_stem in part:
+                logger.debug(f"Can't run cc1 directly because of {part}")
+                return None
+        if not {"source", "output"} <= {role for _, role in roles}:
+            return None
+        return argv, roles
+
+    async def _cc1_command(self, formatted, source_file, output_file, caller_directory):
+        """The cc1 command the driver would run for formatted, or None if it can't be run directly.
+
+        The driver is queried once for each command line, with the file's own paths left out,
+        and its answer is reused for every file compiled the same way.
+        """
+        source, output, dependency = build.format_command([source_file, output_file, output_file.with_suffix(".d")], caller_directory)
+        values = {"source": source, "output": output, "dependency": dependency, "main_file_name": os.path.basename(source)}
+        command = tuple("\0source" if part == source else "\0output" if part == output else part for part in formatted)
+        key = (build.generation, caller_directory, source_file.suffix, command)
+        template = self._cc1_templates.get(key)
+        if template is None:
+            template = self._cc1_templates[key] = asyncio.ensure_future(self._query_cc1(formatted, values, caller_directory))
+        template = await template
+        if template is None:
+            return None
+        argv, roles = template
+        argv = list(argv)
+        for index, role in roles:
+            argv[index] = values[role]
+        return argv
+
+    async def _run_compile(self, command, cpu_flags, source_file, output_file, flags, description, caller_directory, trace_args=None, remote=True, inputs=()):
+        """Compile on a remote worker if one is free, otherwise locally."""
+        outputs = [output_file, output_file.with_suffix(".d")]
+        if build.recorder is None:
+            # Outputs restored by earlier versions may be hardlinks into the object cache, so
+            # write new files rather than over them.
+            for output in outputs:
+                output.unlink(missing_ok=True)
+        executor = build.remote.executor
+        if executor is not None and remote and build.recorder is None and source_file.suffix == ".c":
+            reservation = await executor.reserve()
+            if reservation is not None:
+                try:
+                    await self._compile_remote(reservation, cpu_flags, source_file, output_file, flags, description, caller_directory, trace_args)
+                    return
+                except build.remote.RemoteError as e:
+                    logger.warning(f"{description} failed remotely, compiling locally: {e}")
+                finally:
+                    executor.release(reservation)
+        result = await build.run_command(command, description=description, working_directory=caller_directory, inputs=[source_file, *inputs], outputs=outputs, trace_args=trace_args)
+        if self.time_trace:
+            await self._merge_time_trace(output_file, result)
+
+    async def _compile_remote(self, reservation, cpu_flags, source_file, output_file, flags, description, caller_directory, trace_args):
+        """Preprocess locally and compile the result on a worker, like distcc."""
+        executor = build.remote.executor
+        dependency_file = output_file.with_suffix(".d")
+        preprocessed = output_file.with_suffix(".i")
+        # Name the dependency target as a local compile would.
+        target = build.format_command([output_file], caller_directory)[0]
+        await build.run_command([self.c_compiler, *cpu_flags, "-E", "-MMD", "-MF", dependency_file, "-MT", target, "-c", source_file, *flags, "-o", preprocessed],
+                                description=f"Preprocess {source_file.relative_to(cwd)} for remote compile", working_directory=caller_directory, inputs=[source_file], outputs=[preprocessed])
+        argv = [self.c_compiler, *cpu_flags, *self._lto_flags(), "-Wno-unused-command-line-argument", "-c", "input.i", *compile_only_flags(build.format_command(flags, caller_directory)), "-o", "output.o"]
+        start_time = build.trace.now()
+        try:
+            reply = await executor.run(reservation, argv, {"input.i": preprocessed}, {"output.o": output_file})
+        finally:
+            preprocessed.unlink(missing_ok=True)
+        end_time = build.trace.now()
+
+        command_string = shlex.join(argv)
+        if build.trace_sink is not None:
+            args = {"command": command_string, "exit_code": reply["returncode"], "worker": reservation[0].address}
+            args.update(reply.get("rusage", {}))
+            if trace_args:
+                args.update(trace_args)
+            build.trace_sink.complete(f"{description} (remote)", executor.track(reservation), start_time, end_time, args, [preprocessed], [output_file, dependency_file], pid=1)
+        if reply["returncode"] != 0:
+            build.log_failure(reply["output"], f"{reservation[0].address}$ {command_string}")
+            raise RuntimeError()
+        build.record_duration(description, [output_file], start_time, end_time)
+        logger.info(f"{description} (remote)")
 
     @build.capture_caller_directory
     async def compile(self, cpu, source_file: pathlib.Path, output_file: pathlib.Path, flags: list[pathlib.Path], caller_directory : pathlib.Path = None):
@@ -34,17 +285,187 @@ class Clang(Compiler):
             source_file = caller_directory / source_file
         output_file.parent.mkdir(parents=True, exist_ok=True)
         cpu_flags = cpu.get_arch_cflags(self)
-        await build.run_command([self.c_compiler, *cpu_flags, "-MMD", "-c", source_file, *flags, "-o", output_file], description=f"Compile {source_file.relative_to(cwd)} -> {output_file.relative_to(cwd)}", working_directory=caller_directory)
+        precompiled_header = await self._precompiled_header(cpu, flags, caller_directory)
+        extra_inputs = []
+        command = [self.c_compiler, *cpu_flags, *self._lto_flags(), "-MMD", "-c", source_file, *flags, "-o", output_file]
+        if precompiled_header is not None:
+            extra_inputs.append(precompiled_header)
+            command[1 + len(cpu_flags):1 + len(cpu_flags)] = ["-include-pch", precompiled_header]
+        if self.time_trace:
+            command.insert(-2, "-ftime-trace")
+        description = f"Compile {source_file.relative_to(cwd)} -> {output_file.relative_to(cwd)}"
+        outputs = [output_file, output_file.with_suffix(".d")]
+        formatted = build.format_command(command, caller_directory)
+        if self._up_to_date(outputs, formatted, description):
+            return
+
+        # Up to date checks and the object cache still go by the driver's command line.
+        if self.direct_cc1 and build.recorder is None:
+            command = await self._cc1_command(formatted, source_file, output_file, caller_directory) or command
+
+        # The precompiled header isn't part of the preprocessed source so it can't be compiled remotely.
+        remote = precompiled_header is None
+        if self.object_cache is None or build.recorder is not None:
+            await self._run_compile(command, cpu_flags, source_file, output_file, flags, description, caller_directory, remote=remote, inputs=extra_inputs)
+            await self._record(outputs, formatted, working_directory=caller_directory, extra_inputs=extra_inputs)
+            return
+
+        base_key = await asyncio.to_thread(self.object_cache.base_key, formatted, source_file, extra_inputs)
+        key = await asyncio.to_thread(self.object_cache.lookup, base_key, caller_directory)
+        restored = False
+        if key is not None:
+            restored = await build.run_function(self.object_cache.restore, (key, outputs), {}, description=f"{description} (cached)", inputs=[source_file], outputs=outputs, trace_args={"cache": "hit"})
+        if not restored:
+            await self._run_compile(command, cpu_flags, source_file, output_file, flags, description, caller_directory, trace_args={"cache": "miss"}, remote=remote, inputs=extra_inputs)
+            await asyncio.to_thread(self.object_cache.store, base_key, outputs[1], outputs, caller_directory)
+        await self._record(outputs, formatted, working_directory=caller_directory, extra_inputs=extra_inputs)
+    def _object_file(self, source_file, output_directory, caller_directory):
+        relative = os.path.relpath(source_file, caller_directory).replace("..", "__")
+        return output_directory / pathlib.Path(relative).with_suffix(".o")
+
+    def _unity_groups(self, source_files, output_directory, caller_directory) -> dict[str, list[str]]:
+        """Group sources into unity files, keeping the groups of the last build where possible.
+
+        Each source is estimated to take as long as it did on its own or as its share of its
+        group's last compile. Groups that have grown too slow are split up again and new sources
+        are packed, in path order, into new groups of sources with the same suffix.
+        """
+        groups_file = output_directory / "unity.json"
+        try:
+            previous = json.loads(groups_file.read_text())
+        except (OSError, ValueError):
+            previous = {}
+        history = build.step_history
+        default = self.unity_time / self.unity_size
+        estimates = {}
+        for name, members in previous.items():
+            share = None
+            if history is not None and len(members) > 1:
+                duration = history.duration(history.key([output_directory / f"{name}.o"]))
+                if duration is not None:
+                    share = duration / len(members)
+            for member in members:
+                estimates[member] = share
+        def estimate(source):
+            if history is not None:
+                # Members are relative to output_directory.
+                source_file = os.path.normpath(output_directory / source)
+                duration = history.duration(history.key([self._object_file(source_file, output_directory, caller_directory)]))
+                if duration is not None:
+                    return duration
+            return estimates.get(source) or default
+
+        remaining = {os.path.relpath(s, output_directory): s for s in source_files}
+        groups = {}
+        for name, members in previous.items():
+            members = [m for m in members if m in remaining]
+            if not members or len({os.path.splitext(m)[1] for m in members}) > 1 or sum(estimate(m) for m in members) > 2 * self.unity_time:
+                continue
+            groups[name] = members
+            for member in members:
+                del remaining[member]
+
+        names = (f"unity{i}" for i in range(len(previous) + len(remaining) + 1))
+        # The group being filled and its time for each suffix.
+        open_groups = {}
+        for member in sorted(remaining):
+            member_time = estimate(member)
+            suffix = os.path.splitext(member)[1]
+            group, group_time = open_groups.get(suffix, (None, 0))
+            if group is None or len(group) >= self.unity_size or group_time + member_time > self.unity_time:
+                name = next(n for n in names if n not in groups)
+                group = groups[name] = []
+                group_time = 0
+            group.append(member)
+            open_groups[suffix] = (group, group_time + member_time)
+
+        if groups != previous:
+            groups_file.write_text(json.dumps(groups, indent=1))
+        return groups
+
+    @build.capture_caller_directory
+    async def compile_sources(self, cpu, source_files: list[pathlib.Path], output_directory: pathlib.Path, flags: list[pathlib.Path], unity=False, caller_directory: pathlib.Path = None) -> list[pathlib.Path]:
+        """Compile each of source_files into output_directory and return the object files.
+
+        With unity, sources are #included in groups into generated files and each group is
+        compiled once. Groups are sized from past compile times and kept stable between builds,
+        so a change to one source only rebuilds its group. Sources that clash on static symbols
+        should be compiled in a separate set without unity.
+        """
+        if isinstance(output_directory, str):
+            output_directory = caller_directory / output_directory
+        source_files = [caller_directory / s if isinstance(s, str) else s for s in source_files]
+        if not unity:
+            objects = [self._object_file(s, output_directory, caller_directory) for s in source_files]
+            await asyncio.gather(*[self.compile(cpu, s, o, flags, caller_directory=caller_directory) for s, o in zip(source_files, objects)])
+            return objects
+
+        output_directory.mkdir(parents=True, exist_ok=True)
+        alone = [s for s in source_files if s.suffix not in UNITY_SUFFIXES]
+        source_files = [s for s in source_files if s.suffix in UNITY_SUFFIXES]
+        groups = await asyncio.to_thread(self._unity_groups, source_files, output_directory, caller_directory)
+        by_name = {os.path.relpath(s, output_directory): s for s in source_files}
+        objects = [self._object_file(s, output_directory, caller_directory) for s in alone]
+        jobs = [self.compile(cpu, s, o, flags, caller_directory=caller_directory) for s, o in zip(alone, objects)]
+        for name, members in groups.items():
+            if len(members) == 1:
+                source_file = by_name[members[0]]
+                object_file = self._object_file(source_file, output_directory, caller_directory)
+            else:
+                source_file = output_directory / (name + os.path.splitext(members[0])[1])
+                object_file = output_directory / f"{name}.o"
+                contents = "".join(f'#include "{member}"\n' for member in members)
+                # Only write when the group changes so that it isn't rebuilt needlessly.
+                if not source_file.exists() or source_file.read_text() != contents:
+                    source_file.write_text(contents)
+            jobs.append(self.compile(cpu, source_file, object_file, flags, caller_directory=caller_directory))
+            objects.append(object_file)
+        await asyncio.gather(*jobs)
+        return objects
     
     @build.capture_caller_directory
     async def link(self, cpu, objects: list[pathlib.Path], output_file: pathlib.Path, linker_script: pathlib.Path, flags: list[str] = [], print_memory_use=True, output_map_file=True, gc_sections=True, caller_directory=None):
         output_file.parent.mkdir(parents=True, exist_ok=True)
         cpu_flags = cpu.get_arch_cflags(self)
         link_flags = []
+        outputs = [output_file]
         if print_memory_use:
             link_flags.append("-Wl,--print-memory-usage")
+        map_file = None
         if output_map_file:
-            link_flags.append("-Wl,-Map=" + str(output_file.with_suffix(".elf.map").relative_to(caller_directory)))
+            map_file = output_file.with_suffix(".elf.map")
+            outputs.append(map_file)
+            link_flags.append("-Wl,-Map=" + str(map_file.relative_to(caller_directory)))
+        size_file = None
+        # A recorded link has no Python step afterwards to write the size.
+        if (print_memory_use or output_map_file) and build.recorder is None:
+            size_file = output_file.with_suffix(".elf.size.json")
+            outputs.append(size_file)
         if gc_sections:
             link_flags.append("-Wl,--gc-sections")
-        await build.run_command([self.c_compiler, *cpu_flags, *link_flags, *flags, *objects, "-fuse-ld=lld", "-T", linker_script, "-o", output_file], description=f"Link {output_file.relative_to(cwd)}", working_directory=caller_directory)
+        link_flags.extend(self._lto_flags())
+        if self.lto == "thin":
+            link_flags.append(f"-Wl,--thinlto-cache-dir={self.lto_cache_directory}")
+            link_flags.append(f"-Wl,--thinlto-cache-policy=cache_size_bytes={self.lto_cache_size}")
+            # Backend threads use the slots that are free when the link starts.
+            link_flags.append(build.Jobs("-Wl,--thinlto-jobs={}"))
+        command = [self.c_compiler, *cpu_flags, *link_flags, *flags, *objects, "-fuse-ld=lld", "-T", linker_script, "-o", output_file]
+        description = f"Link {output_file.relative_to(cwd)}"
+        formatted = build.format_command(command, caller_directory)
+        if self._up_to_date(outputs, formatted, description):
+            return
+        inputs = [caller_directory / p for p in (*objects, linker_script)]
+        result = await build.run_command(command, description=description, working_directory=caller_directory, inputs=inputs, outputs=outputs, critical=True)
+        if size_file is not None:
+            sizes = await asyncio.to_thread(self._write_size, size_file, map_file, result)
+            # The trace file is written from the event loop only.
+            if build.trace_sink is not None and sizes["regions"]:
+                name = f"memory usage {size_file.name.removesuffix('.size.json')}"
+                build.trace_sink.counters(result.end_time, name, {region: usage["used"] for region, usage in sizes["regions"].items()})
+        await self._record(outputs, formatted, inputs=inputs)
+
+    def _write_size(self, size_file, map_file, result):
+        """Save the size of the linked firmware as JSON and return it."""
+        sizes = build.size.analyze(map_file, result.lines())
+        size_file.write_text(json.dumps(sizes, indent=1, sort_keys=True))
+        return sizes
@@ -1,14 +1,20 @@
+import asyncio
+import collections
 import collections.abc
+import functools
+import hashlib
 import logging
+import os
+import pathlib
+import pickle
+import struct
+import zlib
 from embedded import build
-from lxml import etree
-from cmsis_svd.parser import SVDParser
-try:
-    import cmsis_pack_manager as cmsis_packs
-    from embedded.cpu import arm
-    cmsis_cache = None
-except ImportError:
-    cmsis_packs = None
+from embedded.build import cache
+from embedded.cpu import arm
+# lxml, cmsis_svd and cmsis_pack_manager are slow to import so they're only loaded when needed.
+cmsis_cache = None
+part_index = None
 
 logger = logging.getLogger(__name__)
 
@@ -17,95 +23,344 @@ MB = 1024 * 1024
 
 INDENT = "    "
 
+Field = collections.namedtuple("Field", ("name", "description", "bit_offset", "bit_width"))
+Register = collections.namedtuple("Register", ("name", "description", "address_offset", "size", "fields"))
+Interrupt = collections.namedtuple("Interrupt", ("name", "value"))
+
+class Peripheral:
+    """Peripheral of a CachedDevice. Registers are only loaded from disk when first used."""
+    def __init__(self, device, name, group_name, base_address, derived_from, interrupts, span):
+        self._device = device
+        self.name = name
+        self.group_name = group_name
+        self.base_address = base_address
+        self.derived_from = derived_from
+        self.interrupts = interrupts
+        self._span = span
+
+    @functools.cached_property
+    def registers(self) -> tuple[Register]:
+        return self._device.load_registers(self._span)
+
+class CachedDevice:
+    """Parsed SVD device stored on disk.
+
+    The file is a magic number, the length of a pickled table of peripherals, the table and
+    then the zlib compressed, pickled registers of each peripheral. Register offsets in the table
+    are relative to the end of the table. Peripherals that are derived
+    from another share its registers.
+    """
+    MAGIC = b"EMBSVD01"
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        with path.open("rb") as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError(f"{path} is not a cached device")
+            length, = struct.unpack("<Q", f.read(8))
+            name, table = pickle.loads(f.read(length))
+        self._data_start = len(self.MAGIC) + 8 + length
+        self.name = name
+        self.peripherals = [Peripheral(self, *p) for p in table]
+
+    def load_registers(self, span):
+        offset, length = span
+        with self.path.open("rb") as f:
+            f.seek(self._data_start + offset)
+            return pickle.loads(zlib.decompress(f.read(length)))
+
+    @classmethod
+    def write(cls, device, path: pathlib.Path):
+        """Serialize a cmsis_svd device to path."""
+        blobs = []
+        offset = 0
+        spans = {}
+        table = []
+        for p in device.peripherals:
+            parent = spans.get(p.derived_from) if p.derived_from else None
+            if parent is None:
+                registers = []
+                for r in p.registers:
+                    fields = tuple(Field(f.name, f.description or "", f.bit_offset, f.bit_width) for f in r.fields)
+                    registers.append(Register(r.name, r.description or "", r.address_offset, r.size, fields))
+                blob = zlib.compress(pickle.dumps(tuple(registers), protocol=pickle.HIGHEST_PROTOCOL))
+                blobs.append(blob)
+                spans[p.name] = (offset, len(blob))
+                offset += len(blob)
+            else:
+                spans[p.name] = parent
+            interrupts = tuple(Interrupt(i.name, i.value) for i in (p.interrupts or ()))
+            table.append((p.name, p.group_name, p.base_address, p.derived_from, interrupts, spans[p.name]))
+
+        header = pickle.dumps((device.name, table), protocol=pickle.HIGHEST_PROTOCOL)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = path.with_name(path.name + f".{os.getpid()}")
+        with temporary.open("wb") as f:
+            f.write(cls.MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            for blob in blobs:
+                f.write(blob)
+        temporary.replace(path)
+
+def load_device(pack, svd_filename) -> CachedDevice:
+    """Load the device described by svd_filename in pack, parsing it only if it isn't cached."""
+    stat = os.stat(pack.filename)
+    identity = f"{os.path.realpath(pack.filename)}:{stat.st_size}:{stat.st_mtime_ns}:{svd_filename}"
+    path = cache.default_directory() / "svd" / hashlib.sha256(identity.encode("utf-8")).hexdigest()
+    try:
+        return CachedDevice(path)
+    except (OSError, ValueError, pickle.UnpicklingError):
+        pass
+    from lxml import etree
+    from cmsis_svd.parser import SVDParser
+    with pack.open(svd_filename) as f:
+        parser = SVDParser(etree.parse(f))
+    CachedDevice.write(parser.get_device(), path)
+    return CachedDevice(path)
+
+@functools.cache
+def cmsis_packs():
+    """The cmsis_pack_manager module or None if it isn't installed."""
+    try:
+        import cmsis_pack_manager
+    except ImportError:
+        return None
+    return cmsis_pack_manager
+
+def get_cmsis_cache():
+    global cmsis_cache
+    if cmsis_cache is None:
+        cmsis_cache = cmsis_packs().Cache(True, False)
+    return cmsis_cache
+
+class PartIndex:
+    """Search index over the parts in the CMSIS pack index.
+
+    Part names are indexed by trigram for substring searches. The processors of each part are
+    kept alongside so that resolving a CPU doesn't load anything else. Full device information
+    is stored in a second file that is only loaded when a part's pack or memories are needed.
+    Both are rebuilt when the pack manager's index changes.
+    """
+    VERSION = 1
+
+    def __init__(self, directory: pathlib.Path, index_path: str):
+        self.directory = directory
+        stat = os.stat(index_path)
+        identity = f"{self.VERSION}:{os.path.realpath(index_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        self._key = hashlib.sha256(identity.encode("utf-8")).hexdigest()[:16]
+        self._device_info = None
+        try:
+            with (directory / f"parts-{self._key}").open("rb") as f:
+                self.parts, self.processors, self.trigrams = pickle.load(f)
+        except (OSError, pickle.UnpicklingError):
+            self._build()
+
+    def _build(self):
+        index = get_cmsis_cache().index
+        self.parts = sorted(index.keys())
+        self.processors = []
+        self.trigrams = {}
+        for i, part in enumerate(self.parts):
+            processors = []
+            for processor in index[part].get("processors", ()):
+                processor = dict(processor)
+                svd = processor.pop("svd", None)
+                processors.append((processor, svd))
+            self.processors.append(processors)
+            for trigram in {part[j:j + 3] for j in range(len(part) - 2)}:
+                self.trigrams.setdefault(trigram, []).append(i)
+        self._device_info = index
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for name, value in ((f"parts-{self._key}", (self.parts, self.processors, self.trigrams)),
+                            (f"devices-{self._key}", index)):
+            temporary = self.directory / f"{name}.{os.getpid()}"
+            with temporary.open("wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            temporary.replace(self.directory / name)
+
+    def search(self, substr) -> list[int]:
+        """Return the indices of parts that contain substr."""
+        if len(substr) < 3:
+            return [i for i, part in enumerate(self.parts) if substr in part]
+        candidates = None
+        for trigram in {substr[j:j + 3] for j in range(len(substr) - 2)}:
+            postings = self.trigrams.get(trigram)
+            if postings is None:
+                return []
+            if candidates is None:
+                candidates = set(postings)
+            else:
+                candidates.intersection_update(postings)
+        return sorted(i for i in candidates if substr in self.parts[i])
+
+    def device_info(self, part) -> dict:
+        if self._device_info is None:
+            try:
+                with (self.directory / f"devices-{self._key}").open("rb") as f:
+                    self._device_info = pickle.load(f)
+            except (OSError, pickle.UnpicklingError):
+                self._device_info = get_cmsis_cache().index
+        return self._device_info[part]
+
+def get_part_index() -> PartIndex:
+    global part_index
+    if part_index is None:
+        part_index = PartIndex(cache.default_directory() / "parts", get_cmsis_cache().index_path)
+    return part_index
+
 class Microcontroller:
-    def __init__(self, part, cpu, pack, svd_filename):
+    """A part with one of its processors.
+
+    The pack, the device information and the SVD device are loaded on first use so that
+    Microcontrollers can be created cheaply from search results. With streaming_svd, the SVD is
+    extracted from the pack once and read with a streaming parser that only builds the
+    registers of the peripherals that are used. That suits very large SVDs.
+    """
+    def __init__(self, part, cpu, pack=None, svd_filename=None, device_info=None, streaming_svd=False):
         self.part = part
         self.cpu = cpu
-        self.pack = pack
+        self.streaming_svd = streaming_svd
+        if pack is not None:
+            self.pack = pack
+        if device_info is not None:
+            self.device_info = device_info
         self.svd = svd_filename
-        with self.pack.open(self.svd) as f:
-            parser = SVDParser(etree.parse(f))
-        self.device = parser.get_device()
+
+    def __getstate__(self):
+        # The pack and device hold open files so they're loaded again after unpickling.
+        state = {"part": self.part, "cpu": self.cpu, "svd": self.svd, "streaming_svd": self.streaming_svd}
+        if "device_info" in self.__dict__:
+            state["device_info"] = self.device_info
+        return state
+
+    @functools.cached_property
+    def device_info(self) -> dict:
+        return get_part_index().device_info(self.part)
+
+    @functools.cached_property
+    def pack(self):
+        return get_cmsis_cache().pack_from_cache(self.device_info)
+
+    @functools.cached_property
+    def device(self) -> CachedDevice:
+        if self.streaming_svd:
+            from embedded.microcontroller import svd
+            return svd.StreamedDevice(svd.extract(self.pack, self.svd))
+        return load_device(self.pack, self.svd)
+
+    @staticmethod
+    def _render_peripheral_types(peripheral) -> str:
+        """Render the register and peripheral typedefs of a non-derived peripheral."""
+        output = []
+        registers = []
+        raw_registers = []
+        register_offset = 0
+        sorted_registers = sorted(peripheral.registers, key=lambda x: x.address_offset)
+        for r in sorted_registers:
+            while register_offset < r.address_offset:
+                registers.append(f"{INDENT}uint32_t reserved_0x{register_offset:x};\n\n")
+                raw_registers.append(f"{INDENT}uint32_t reserved_0x{register_offset:x};\n\n")
+                register_offset += 4
+
+            r_description = r.description
+            if "\n" in r_description:
+                r_description = " ".join([x.strip() for x in r_description.split("\n")])
+            fields = list(r.fields)
+            reg_comment = (f"{INDENT}// {r_description}\n{INDENT}//\n",
+                           f"{INDENT}// Address offset: 0x{r.address_offset:x} Size: {r.size} bits\n")
+            registers.extend(reg_comment)
+            raw_registers.extend(reg_comment)
+            register_offset += r.size // 8 + (1 if r.size % 8 else 0)
+            if len(fields) == 1 and fields[0].bit_offset == 0 and fields[0].bit_width == r.size:
+                registers.append(f"{INDENT}volatile uint32_t {r.name};\n\n")
+                raw_registers.append(f"{INDENT}volatile uint32_t {r.name};\n\n")
+            else:
+                field_offset = 1
+                output.append(f"// {r_description}\n")
+                output.append(f"typedef struct _{peripheral.group_name}_{r.name}_Type {{\n")
+                fields.sort(key=lambda x: x.bit_offset)
+                for f in fields:
+                    description = f.description
+                    if "\n" in description:
+                        description = " ".join([x.strip() for x in description.split("\n")])
+                    if field_offset < f.bit_offset:
+                        output.append(f"{INDENT}int reserved_{field_offset}: {f.bit_offset - field_offset};\n")
+
+                    field_offset = f.bit_offset + f.bit_width
+                    if f.bit_width == 1:
+                        field_type = "bool"
+                    elif f.bit_width <= 8:
+                        field_type = "uint8_t"
+                    else:
+                        field_type = "int"
+                    output.append(f"{INDENT}{field_type} {f.name}: {f.bit_width}; // {f.bit_offset} {description}\n")
+                if field_offset < r.size:
+                    output.append(f"{INDENT}int reserved_{field_offset}: {r.size - field_offset};\n")
+                output.append(f"}} {peripheral.group_name}_{r.name}_Type;\n")
+                output.append(f"_Static_assert(sizeof({peripheral.group_name}_{r.name}_Type) == {r.size // 8}, \"Size of {peripheral.group_name}_{r.name}_Type does not match register size\");\n\n")
+                registers.append(f"{INDENT}volatile {peripheral.group_name}_{r.name}_Type {r.name};\n\n")
+                raw_registers.append(f"{INDENT}volatile uint32_t {r.name};\n\n")
+        output.append(f"typedef struct _{peripheral.group_name}_Type {{\n")
+        output.extend(registers)
+        output.append(f"}} {peripheral.group_name}_Type;\n\n")
+        output.append(f"typedef struct _{peripheral.group_name}_Raw_Type {{\n")
+        output.extend(raw_registers)
+        output.append(f"}} {peripheral.group_name}_Raw_Type;\n\n")
+        return "".join(output)
+
+    def _write_c_headers(self, targets: dict[str, pathlib.Path]):
+        """Write a header for each target peripheral in one pass over the device."""
+        bodies = {target: [] for target in targets}
+        instances = {target: [] for target in targets}
+        selected = []
+        for peripheral in self.device.peripherals:
+            matches = [t for t in dict.fromkeys((peripheral.group_name, peripheral.name, peripheral.derived_from)) if t in targets]
+            if matches:
+                selected.append((peripheral, matches))
+        if self.streaming_svd:
+            self.device.load([peripheral.name for peripheral, _ in selected if peripheral.derived_from is None])
+        for peripheral, matches in selected:
+            instance = (f"{peripheral.group_name}_Type* {peripheral.name} = ({peripheral.group_name}_Type*) 0x{peripheral.base_address:08x};\n"
+                        f"{peripheral.group_name}_Raw_Type* {peripheral.name}_REGS = ({peripheral.group_name}_Raw_Type*) 0x{peripheral.base_address:08x};\n")
+            for target in matches:
+                instances[target].append(instance)
+            if peripheral.derived_from is not None:
+                continue
+            # Rendered once and shared by every header that includes this peripheral.
+            types = self._render_peripheral_types(peripheral)
+            for target in matches:
+                bodies[target].append(types)
+
+        for target, output_file in targets.items():
+            content = "".join(("#pragma once\n\n#include <stdbool.h>\n#include <stdint.h>\n\n", *bodies[target], *instances[target]))
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            # Leave unchanged headers alone so their timestamps don't trigger rebuilds.
+            try:
+                if output_file.read_text() == content:
+                    continue
+            except FileNotFoundError:
+                pass
+            output_file.write_text(content)
 
     @build.run_in_thread
     def generate_c_header(self, target_peripheral, output_file):
-        output_file.parent.mkdir(parents=True, exist_ok=True)
-        with output_file.open("w") as output:
-            output.write("#pragma once\n\n#include <stdbool.h>\n#include <stdint.h>\n\n")
-            instances = []
-            for peripheral in self.device.peripherals:
-                if target_peripheral != peripheral.group_name and target_peripheral != peripheral.name and target_peripheral != peripheral.derived_from:
-                    continue
-                instances.append(f"{peripheral.group_name}_Type* {peripheral.name} = ({peripheral.group_name}_Type*) 0x{peripheral.base_address:08x};\n")
-                instances.append(f"{peripheral.group_name}_Raw_Type* {peripheral.name}_REGS = ({peripheral.group_name}_Raw_Type*) 0x{peripheral.base_address:08x};\n")
-                if peripheral.derived_from is not None:
-                    continue
-                registers = []
-                raw_registers = []
-                register_offset = 0
-                sorted_registers = sorted(peripheral.registers, key=lambda x: x.address_offset)
-                for r in sorted_registers:
-                    while register_offset < r.address_offset:
-                        registers.append(f"{INDENT}uint32_t reserved_0x{register_offset:x};\n\n")
-                        raw_registers.append(f"{INDENT}uint32_t reserved_0x{register_offset:x};\n\n")
-                        register_offset += 4
-                    
-                    r_description = r.description
-                    if "\n" in r_description:
-                        r_description = " ".join([x.strip() for x in r_description.split("\n")])
-                    fields = list(r.fields)
-                    reg_comment = (f"{INDENT}// {r_description}\n{INDENT}//\n",
-                                   f"{INDENT}// Address offset: 0x{r.address_offset:x} Size: {r.size} bits\n")
-                    registers.extend(reg_comment)
-                    raw_registers.extend(reg_comment)
-                    register_offset += r.size // 8 + (1 if r.size % 8 else 0)
-                    if len(fields) == 1 and fields[0].bit_offset == 0 and fields[0].bit_width == r.size:
-                        registers.append(f"{INDENT}volatile uint32_t {r.name};\n\n")
-                        raw_registers.append(f"{INDENT}volatile uint32_t {r.name};\n\n")
-                    else:
-                        field_offset = 1
-                        output.write(f"// {r_description}\n")
-                        output.write(f"typedef struct _{peripheral.group_name}_{r.name}_Type {{\n")
-                        fields.sort(key=lambda x: x.bit_offset)
-                        for f in fields:
-                            description = f.description
-                            if "\n" in description:
-                                description = " ".join([x.strip() for x in description.split("\n")])
-                            if field_offset < f.bit_offset:
-                                output.write(f"{INDENT}int reserved_{field_offset}: {f.bit_offset - field_offset};\n")
-                                
-                            field_offset = f.bit_offset + f.bit_width
-                            if f.bit_width == 1:
-                                field_type = "bool"
-                            elif f.bit_width <= 8:
-                                field_type = "uint8_t"
-                            else:
-                                field_type = "int"
-                            output.write(f"{INDENT}{field_type} {f.name}: {f.bit_width}; // {f.bit_offset} {description}\n")
-                        if field_offset < r.size:
-                            output.write(f"{INDENT}int reserved_{field_offset}: {r.size - field_offset};\n")
-                        output.write(f"}} {peripheral.group_name}_{r.name}_Type;\n")
-                        output.write(f"_Static_assert(sizeof({peripheral.group_name}_{r.name}_Type) == {r.size // 8}, \"Size of {peripheral.group_name}_{r.name}_Type does not match register size\");\n\n")
-                        registers.append(f"{INDENT}volatile {peripheral.group_name}_{r.name}_Type {r.name};\n\n")
-                        raw_registers.append(f"{INDENT}volatile uint32_t {r.name};\n\n")
-                output.write(f"typedef struct _{peripheral.group_name}_Type {{\n")
-                for r in registers:
-                    output.write(r)
-                output.write(f"}} {peripheral.group_name}_Type;\n\n")
-                output.write(f"typedef struct _{peripheral.group_name}_Raw_Type {{\n")
-                for r in raw_registers:
-                    output.write(r)
-                output.write(f"}} {peripheral.group_name}_Raw_Type;\n\n")
-            for i in instances:
-                output.write(i)
+        self._write_c_headers({target_peripheral: output_file})
 
     @build.run_in_thread
-    def generate_linker_script(self, output_file, flash_start_offset=0):
-        global cmsis_cache
-        if cmsis_cache is None:
-            cmsis_cache = cmsis_packs.Cache(True, False)
+    def generate_c_headers(self, target_peripherals, output_directory) -> dict[str, pathlib.Path]:
+        """Generate a header named after each target peripheral, or every peripheral group for "all"."""
+        if target_peripherals == "all":
+            target_peripherals = dict.fromkeys(p.group_name for p in self.device.peripherals)
+        targets = {target: output_directory / f"{target}.h" for target in target_peripherals}
+        self._write_c_headers(targets)
+        return targets
 
-        device_info = cmsis_cache.index[self.part]
+    @build.run_in_thread
+    def generate_linker_script(self, output_file, flash_start_offset=0):
+        device_info = self.device_info
         with output_file.open("w") as output_file:
             output_file.write("MEMORY {\n")
             # Nonvolatile memory (nvm) is where everything stored at start up.
@@ -173,11 +428,6 @@ class Microcontroller:
 
     @build.run_in_thread
     def generate_startup_source(self, output_file, flash_start_offset=0, first_function="main", interrupts_used={}):
-        global cmsis_cache
-        if cmsis_cache is None:
-            cmsis_cache = cmsis_packs.Cache(True, False)
-
-        device_info = cmsis_cache.index[self.part]
         interrupts = {}
         interrupt_name_to_value = {}
         for p in self.device.peripherals:
@@ -251,60 +501,95 @@ class Microcontroller:
             output_file.write("}\n")
 
     def __str__(self):
-        return f"{self.part} {self.cpu} {self.pack} {self.svd}"
+        return f"{self.part} {self.cpu} {self.svd}"
 
     def __repr__(self):
-        return f"Microcontroller({self.part}, {self.cpu}, {self.pack}, {self.svd})"
+        return f"Microcontroller({self.part}, {self.cpu}, {self.svd})"
 
 def get_mcus_from_string(substr) -> list[Microcontroller]:
-    global cmsis_cache
-    if not cmsis_packs:
+    if not cmsis_packs():
         return []
 
-    if cmsis_cache is None:
-        cmsis_cache = cmsis_packs.Cache(True, False)
-
+    index = get_part_index()
     mcus = []
-    for part in cmsis_cache.index.keys():
-        if substr in part:
-            device_info = cmsis_cache.index[part]
-            if "processor" in device_info:
-                logger.warning(device_info["processor"])
-            if "processors" in device_info:
-                for processor in device_info["processors"]:
-                    if "svd" in processor:
-                        svd = processor["svd"]
-                        del processor["svd"]
-                    else:
-                        svd = None
-                    cpu = arm.ARM.from_pdsc(processor)
-                    mcus.append(Microcontroller(part, cpu, cmsis_cache.pack_from_cache(device_info), svd))
+    for i in index.search(substr):
+        for processor, svd in index.processors[i]:
+            cpu = arm.ARM.from_pdsc(processor)
+            mcus.append(Microcontroller(index.parts[i], cpu, svd_filename=svd))
     return mcus
 
+def _generate_files(mcu, output_directory, peripherals, flash_start_offset):
+    """Generate the headers, linker script and startup source of mcu. Run in a worker process."""
+    output_directory.mkdir(parents=True, exist_ok=True)
+    mcu.generate_c_headers.__wrapped__(mcu, peripherals, output_directory)
+    mcu.generate_linker_script.__wrapped__(mcu, output_directory / "linker.ld", flash_start_offset)
+    mcu.generate_startup_source.__wrapped__(mcu, output_directory / "startup.c", flash_start_offset)
+    return output_directory
+
+async def generate_fleet(patterns, output_directory, peripherals="all", flash_start_offset=0) -> dict[str, pathlib.Path]:
+    """Generate code for every MCU matching patterns into a directory per part under output_directory.
+
+    Parts are generated in worker processes so that parsing and rendering run in parallel. Parts
+    with several processors get a directory per processor. Returns the directory of each. Parts
+    with a core we don't know, and parts that fail, are logged and left out.
+    """
+    # Started here, before this function starts any threads, and only for builds that use it.
+    pool = build.get_process_pool()
+    mcus = {}
+    for pattern in patterns:
+        for mcu in get_mcus_from_string(pattern):
+            if mcu.cpu is None:
+                logger.warning(f"Skipping {mcu.part}: unsupported core")
+                continue
+            mcus.setdefault((mcu.part, mcu.cpu.unique_id), mcu)
+    parts = collections.Counter(part for part, _ in mcus)
+    total = len(mcus)
+    done = 0
+    failed = 0
+    def progress():
+        if build.trace_sink is not None:
+            build.trace_sink.counters(build.trace.now(), "fleet", {"done": done, "failed": failed, "remaining": total - done - failed})
+
+    async def generate(name, mcu):
+        nonlocal done, failed
+        try:
+            result = await build.run_function(_generate_files, (mcu, output_directory / name, peripherals, flash_start_offset), {},
+                                              description=f"Generate {name}", executor=pool)
+        except Exception as e:
+            failed += 1
+            logger.error(f"Generating {name} failed: {e!r}")
+            raise
+        else:
+            done += 1
+        finally:
+            progress()
+        return name, result
+
+    progress()
+    jobs = []
+    for (part, cpu), mcu in mcus.items():
+        name = part if parts[part] == 1 else f"{part}-{cpu}"
+        jobs.append(generate(name, mcu))
+    # One bad part doesn't stop the rest.
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    if failed:
+        logger.error(f"{failed} of {total} parts failed")
+    return dict(r for r in results if not isinstance(r, BaseException))
+
 def get_cpu_from_mcu(substr):
-    if not cmsis_packs:
+    if not cmsis_packs():
         return None
 
-    cmsis_cache = cmsis_packs.Cache(True, False)
-    print(cmsis_cache)
-
+    index = get_part_index()
     target_processor = None
-    for part in cmsis_cache.index.keys():
-        if substr in part:
-            print(part)
-            device_info = cmsis_cache.index[part]
-            print(device_info)
-            print(cmsis_cache.pdsc_from_cache(device_info).read())
-            print(cmsis_cache.pack_from_cache(device_info).namelist())
-            if "processor" in device_info:
-                logger.warning(device_info["processor"])
-            if "processors" in device_info:
-                for processor in device_info["processors"]:
-                    if "svd" in processor:
-                        del processor["svd"]
-                    if target_processor is None:
-                        target_processor = processor
-                    elif target_processor != processor:
-                        logger.error("mismatched processor", target_processor, processor)
+    for i in index.search(substr):
+        logger.debug(index.parts[i])
+        for processor, _ in index.processors[i]:
+            if target_processor is None:
+                target_processor = processor
+            elif target_processor != processor:
+                logger.error(f"mismatched processor {target_processor} {processor}")
+    if target_processor is None:
+        return None
     cpu = arm.ARM.from_pdsc(target_processor)
-    return cpu
\ No newline at end of file
+    return cpu
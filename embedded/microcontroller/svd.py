@@ -0,0 +1,256 @@
+"""Streaming SVD reader for large devices.
+
+Pack members are extracted once into a store keyed by the pack's content and SVDs are read
+from memory maps with iterparse, so no DOM of the whole device is ever built.
+"""
+
+import functools
+import hashlib
+import mmap
+import os
+import pathlib
+import re
+import xml.etree.ElementTree as ElementTree
+
+from embedded.build import cache
+from embedded.microcontroller import Field, Register, Interrupt
+
+def _pack_digest(filename) -> str:
+    """Content hash of a pack, remembered by path, size and mtime so packs are hashed only once."""
+    stat = os.stat(filename)
+    identity = f"{os.path.realpath(filename)}:{stat.st_size}:{stat.st_mtime_ns}"
+    memo = cache.default_directory() / "packs" / "identities" / hashlib.sha256(identity.encode("utf-8")).hexdigest()
+    try:
+        return memo.read_text()
+    except OSError:
+        pass
+    digest = cache.hash_file(filename)
+    memo.parent.mkdir(parents=True, exist_ok=True)
+    temporary = memo.with_name(memo.name + f".{os.getpid()}")
+    temporary.write_text(digest)
+    temporary.replace(memo)
+    return digest
+
+def extract(pack, member) -> pathlib.Path:
+    """Path to member of pack, a zipfile, extracted the first time it's asked for."""
+    relative = pathlib.PurePosixPath(member)
+    if relative.is_absolute() or ".." in relative.parts:
+        raise ValueError(f"Invalid pack member {member}")
+    path = cache.default_directory() / "packs" / _pack_digest(pack.filename) / relative
+    if path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(path.name + f".{os.getpid()}")
+    with pack.open(member) as source, temporary.open("wb") as destination:
+        while chunk := source.read(1024 * 1024):
+            destination.write(chunk)
+    temporary.replace(path)
+    return path
+
+def _int(text) -> int:
+    text = text.strip().lower()
+    if text.startswith("#"):
+        return int(text[1:], 2)
+    if text.startswith("0x"):
+        return int(text, 16)
+    return int(text)
+
+def _text(element, name, default=None):
+    for child in element:
+        if child.tag == name:
+            return child.text or ""
+    return default
+
+def _dim_names(element):
+    """Names and offset increments of an element that may be a dim array."""
+    name = _text(element, "name")
+    dim = _text(element, "dim")
+    if dim is None:
+        return [(name, 0)]
+    dim = _int(dim)
+    increment = _int(_text(element, "dimIncrement", "0"))
+    index = _text(element, "dimIndex")
+    if index is None:
+        indices = [str(i) for i in range(dim)]
+    elif re.fullmatch(r"\s*\d+\s*-\s*\d+\s*", index):
+        first, last = (int(i) for i in index.split("-"))
+        indices = [str(i) for i in range(first, last + 1)]
+    else:
+        indices = [i.strip() for i in index.split(",")]
+    # Array names such as REG[%s] become REG0, REG1 so they're usable as C identifiers.
+    return [(name.replace("[%s]", i).replace("%s", i), n * increment) for n, i in enumerate(indices[:dim])]
+
+def _fields(register) -> tuple[Field]:
+    fields = []
+    for element in register:
+        if element.tag != "fields":
+            continue
+        for field in element:
+            if field.tag != "field":
+                continue
+            description = _text(field, "description", "")
+            if _text(field, "bitOffset") is not None:
+                offset = _int(_text(field, "bitOffset"))
+                width = _int(_text(field, "bitWidth", "1"))
+            elif _text(field, "lsb") is not None:
+                offset = _int(_text(field, "lsb"))
+                width = _int(_text(field, "msb")) - offset + 1
+            else:
+                msb, lsb = (int(b) for b in _text(field, "bitRange").strip("[] ").split(":"))
+                offset = lsb
+                width = msb - lsb + 1
+            for name, increment in _dim_names(field):
+                fields.append(Field(name, description, offset + increment, width))
+    return tuple(fields)
+
+def _registers(parent, size, base_offset=0, prefix="") -> list[Register]:
+    """Registers of a <registers> or <cluster> element with clusters flattened into it."""
+    registers = []
+    by_name = {}
+    for element in parent:
+        tag = element.tag
+        if tag == "register":
+            register_size = _int(_text(element, "size", str(size)))
+            fields = _fields(element)
+            description = _text(element, "description", "")
+            derived_from = element.get("derivedFrom")
+            if derived_from in by_name and not fields:
+                fields = by_name[derived_from].fields
+            offset = base_offset + _int(_text(element, "addressOffset"))
+            for name, increment in _dim_names(element):
+                register = Register(prefix + name, description, offset + increment, register_size, fields)
+                by_name[register.name] = register
+                registers.append(register)
+        elif tag == "cluster":
+            cluster_size = _int(_text(element, "size", str(size)))
+            offset = base_offset + _int(_text(element, "addressOffset"))
+            for name, increment in _dim_names(element):
+                registers.extend(_registers(element, cluster_size, offset + increment, f"{prefix}{name}_"))
+    return registers
+
+class Peripheral:
+    """Peripheral of a StreamedDevice. Registers are parsed from the SVD when first used."""
+    def __init__(self, device, name, group_name, base_address, derived_from, interrupts, has_registers):
+        self._device = device
+        self.name = name
+        self.group_name = group_name
+        self.base_address = base_address
+        self.derived_from = derived_from
+        self.interrupts = interrupts
+        self._has_registers = has_registers
+
+    @functools.cached_property
+    def registers(self) -> tuple[Register]:
+        self._device.load((self.name,))
+        return self.__dict__["registers"]
+
+class StreamedDevice:
+    """Device read from an SVD file with a streaming parser.
+
+    Peripherals are listed from one pass over the file that drops register definitions as it
+    goes. load() parses the registers of the peripherals asked for, and those they're derived
+    from, in a second pass. Sizes are inherited from the device, peripheral and cluster.
+    """
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.name = None
+        self.size = 32
+        self.peripherals = []
+        by_name = {}
+        for depth, element in self._elements(lambda name: False):
+            if depth == 1 and element.tag == "name":
+                self.name = element.text
+            elif depth == 1 and element.tag == "size":
+                self.size = _int(element.text)
+            elif element.tag == "peripheral":
+                name = _text(element, "name")
+                derived_from = element.get("derivedFrom")
+                group_name = _text(element, "groupName")
+                interrupts = tuple(Interrupt(_text(i, "name"), _int(_text(i, "value"))) for i in element if i.tag == "interrupt")
+                has_registers = any(child.tag == "registers" for child in element)
+                peripheral = Peripheral(self, name, group_name, _int(_text(element, "baseAddress")), derived_from, interrupts, has_registers)
+                by_name[name] = peripheral
+                self.peripherals.append(peripheral)
+                element.clear()
+        self._by_name = by_name
+        # A parent can come after the peripherals derived from it, so inherit once all are read.
+        resolved = set()
+        def inherit(peripheral, seen):
+            if peripheral.name in resolved:
+                return
+            parent = by_name.get(peripheral.derived_from)
+            if parent is not None and parent.name not in seen:
+                inherit(parent, seen | {peripheral.name})
+                if peripheral.group_name is None:
+                    peripheral.group_name = parent.group_name
+                if not peripheral.interrupts:
+                    peripheral.interrupts = parent.interrupts
+            if peripheral.group_name is None:
+                peripheral.group_name = peripheral.name
+            resolved.add(peripheral.name)
+        for peripheral in self.peripherals:
+            inherit(peripheral, frozenset())
+
+    def _elements(self, keep):
+        """Yield (depth, element) for the device's own elements and each peripheral as they end.
+
+        Register definitions are dropped unless keep(peripheral name) is true so that memory use
+        doesn't grow with the size of the file.
+        """
+        depth = 0
+        peripheral = None
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for event, element in ElementTree.iterparse(data, events=("start", "end")):
+                if event == "start":
+                    depth += 1
+                    continue
+                depth -= 1
+                tag = element.tag
+                if tag == "register" or tag == "cluster":
+                    if not keep(peripheral):
+                        element.clear()
+                elif depth == 3 and tag == "name":
+                    # The peripheral's name comes before its registers.
+                    peripheral = element.text
+                elif depth == 1 or tag == "peripheral":
+                    yield depth, element
+
+    def _own_registers(self, element):
+        for child in element:
+            if child.tag == "registers":
+                size = _int(_text(element, "size", str(self.size)))
+                return tuple(_registers(child, size))
+        return ()
+
+    def load(self, names):
+        """Parse the registers of the named peripherals in one pass."""
+        wanted = set()
+        for name in names:
+            peripheral = self._by_name.get(name)
+            # Derived peripherals without registers of their own use their parent's.
+            while peripheral is not None and peripheral.name not in wanted:
+                if "registers" not in peripheral.__dict__:
+                    wanted.add(peripheral.name)
+                peripheral = self._by_name.get(peripheral.derived_from) if not peripheral._has_registers else None
+        if not wanted:
+            return
+        for depth, element in self._elements(wanted.__contains__):
+            if element.tag != "peripheral":
+                continue
+            peripheral = self._by_name.get(_text(element, "name"))
+            if peripheral is not None and peripheral.name in wanted and peripheral._has_registers:
+                peripheral.__dict__["registers"] = self._own_registers(element)
+            element.clear()
+        # Resolve derived peripherals now that their parents are loaded.
+        for name in wanted:
+            peripheral = self._by_name[name]
+            chain = []
+            while "registers" not in peripheral.__dict__:
+                chain.append(peripheral)
+                parent = self._by_name.get(peripheral.derived_from)
+                if parent is None or peripheral._has_registers:
+                    peripheral.__dict__["registers"] = ()
+                    break
+                peripheral = parent
+            for derived in chain:
+                derived.__dict__["registers"] = peripheral.__dict__["registers"]
@@ -0,0 +1,16 @@
+import json
+import subprocess
+import sys
+
+# Imported when a build needs them rather than when a build script starts.
+HEAVY_MODULES = ("lxml", "cmsis_svd", "cmsis_pack_manager", "colorlog")
+
+def test_cli_import_is_light():
+    code = "import embedded.cli, json, sys; print(json.dumps(sorted(sys.modules)))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True)
+    loaded = {name.split(".")[0] for name in json.loads(result.stdout)}
+    # -X importtime reports every module imported, as "import time: self | cumulative | name".
+    imported = {line.rsplit("|", 1)[-1].strip().split(".")[0] for line in result.stderr.splitlines() if line.startswith("import time:")}
+    for module in HEAVY_MODULES:
+        assert module not in loaded
+        assert module not in imported